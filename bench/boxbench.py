@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+boxbench: microbenchmarks for the boxbot hot paths
+
+Runs offline: feeds come from the recorded fixture in bench/fixtures, IRC
+output goes to a proto_helpers.StringTransport and the outbound scheduler
+runs on a task.Clock. Reports ops/sec, p50/p99 latency and the objects
+each operation leaves alive (a leak check; python 2 can't count all
+allocations), and compares against a stored baseline.
+
+Usage:
+    python2.7 bench/boxbench.py                 # run and compare
+    python2.7 bench/boxbench.py --save          # store results as baseline
+    python2.7 bench/boxbench.py -k feed -n 200  # only matching, 200 ops
+
+Baselines are machine-specific: record one on the machine you compare on.
+"""
+
+import os
+import sys
+import gc
+import re
+import json
+import time
+import logging
+import argparse
+import datetime
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'boxbot'))
+
+# log records are created as in production (info level), but not written
+logging.getLogger().addHandler(logging.NullHandler())
+logging.getLogger().setLevel(logging.INFO)
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.words.protocols.irc import attributes
+import feedparser
+
+import boxbot
+import rssfeed
+import urltitle
+import clock
+
+timer = time.time
+if sys.platform == 'win32':
+    timer = time.clock
+
+fixtureFile = os.path.join(here, 'fixtures', 'proboards.rss')
+defaultBaseline = os.path.join(here, 'baseline.json')
+
+config = {
+    'nickname': 'boxbot',
+    'realname': 'boxbot',
+    'build': 'bench',
+    'channel': '#bench',
+    'network': {'host': 'localhost', 'port': 6667},
+    'rss': {'url': 'http://forum.example.com/rss/public', 'freq': 60},
+    'quakeAuth': {'authName': 'bench', 'authPass': 'bench'},
+    'notifyComics': {'comics': {'Bench Comic': {0: [8, 0], 2: [8, 0], 4: [8, 0]}},
+        'defaultComic': 'Bench Comic'},
+    'twitter': {},
+    'urltitle': {'engine': 'thread'},
+}
+
+chatter = [
+    "so did anyone read the new page yet",
+    "see http://forum.example.com/thread/9012/ and www.example.com/comic",
+    "boxbot is the best bot",
+    "boxbot: unsilence",
+    "no links here, just a fairly ordinary line of channel chatter " * 2,
+]
+
+
+# fixtures
+
+def largeFeed(copies):
+    """The recorded fixture with its items repeated copies times: thread
+    ids made unique and the posts pushed back an hour per copy"""
+    with open(fixtureFile) as handle:
+        doc = handle.read()
+    head, rest = doc.split('<item>', 1)
+    items, tail = rest.rsplit('</item>', 1)
+    items = '<item>' + items + '</item>'
+    start = datetime.datetime(2015, 10, 12, 9, 0, 0)
+    copied = []
+    for k in range(copies):
+        item = re.sub(r'/thread/(\d+)/', lambda m: '/thread/%d/' % (int(m.group(1)) + 10000 * k), items)
+        date = (start - datetime.timedelta(hours=k)).strftime('%a, %d %b %Y %H:%M:%S GMT')
+        item = re.sub(r'<pubDate>.*?</pubDate>', '<pubDate>%s</pubDate>' % date, item)
+        copied.append(item)
+    return head + '\n'.join(copied) + tail
+
+def makeBot():
+    """A Bot connected to a StringTransport, sending without flood limits"""
+    factory = boxbot.BotFactory(config)
+    bot = boxbot.Bot(factory)
+    fakeClock = task.Clock()
+    bot.outbound.clock = fakeClock
+    bot.outbound.burst = bot.outbound.tokens = float('inf')
+    transport = proto_helpers.StringTransport()
+    bot.makeConnection(transport)
+    factory.hub.titleCache.put("http://forum.example.com/thread/9012/", "Title: [1523] Chapter 46: Page 12")
+    factory.hub.titleCache.put("http://www.example.com/comic", "Title: Example Comic")
+
+    def flush():
+        fakeClock.advance(0)
+        transport.clear()
+    return bot, flush
+
+
+# benchmarks: each returns an operation to be timed
+
+def benchParseUrls():
+    lines = [l.decode('utf-8') for l in chatter]
+    state = {'i': 0}
+
+    def op():
+        state['i'] += 1
+        urltitle.parseUrls(lines[state['i'] % len(lines)])
+    return op
+
+def benchApplyColorFormat():
+    bot, flush = makeBot()
+
+    def op():
+        bot.applyColorFormat(u"Someone", u" tweeted ", u"a tweet of some length", u" - http://t.co/x",
+                colors=(None, None, attributes.fg.blue, None))
+    return op
+
+def benchAnnounce():
+    bot, flush = makeBot()
+
+    def op():
+        bot.announce(u"Someone posted to 'a thread' http://forum.example.com/threads/recent/1")
+        flush()
+    return op
+
+def benchPrivmsg():
+    bot, flush = makeBot()
+    state = {'i': 0}
+
+    def op():
+        state['i'] += 1
+        bot.privmsg('someone!user@example.com', config['channel'], chatter[state['i'] % len(chatter)])
+        flush()
+    return op
+
+def benchReadThreadEntries(warm):
+    entries = feedparser.parse(largeFeed(100)).entries
+    feed = rssfeed.Feed(config['rss']['url'], 60)
+    feed.updatedThreads = []
+    feed._readThreadEntries(entries)
+    feed.first = False
+
+    def op():
+        if not warm:
+            feed.threadStore = rssfeed.ThreadStore()
+            feed.first = True
+        feed.updatedThreads = []
+        feed._readThreadEntries(entries)
+        feed._setCurrentTopic()
+    return op
+
+def benchTimeUntilNextUpdate():
+    schedule = {0: datetime.time(8, 0), 2: datetime.time(8, 0), 4: datetime.time(8, 0)}
+
+    def op():
+        clock.timeUntilNextUpdate(schedule)
+    return op
+
+benchmarks = [
+    ('urltitle.parseUrls', benchParseUrls),
+    ('Bot.applyColorFormat', benchApplyColorFormat),
+    ('Bot.announce', benchAnnounce),
+    ('Bot.privmsg', benchPrivmsg),
+    ('Feed._readThreadEntries (500 items, cold)', lambda: benchReadThreadEntries(False)),
+    ('Feed._readThreadEntries (500 items, warm)', lambda: benchReadThreadEntries(True)),
+    ('clock.timeUntilNextUpdate', benchTimeUntilNextUpdate),
+]
+
+
+# measuring
+
+def percentile(sortedTimes, p):
+    return sortedTimes[min(len(sortedTimes) - 1, int(p * len(sortedTimes)))]
+
+def measureRetained(op, n):
+    """gc-tracked objects per op still alive after n ops and a collection:
+    what an op leaks or caches, not what it allocates"""
+    gc.collect()
+    before = len(gc.get_objects())
+    for i in xrange(n):
+        op()
+    gc.collect()
+    return (len(gc.get_objects()) - before) / float(n)
+
+def run(name, makeOp, n):
+    op = makeOp()
+    for i in xrange(max(1, n // 10)):
+        op()
+    times = []
+    for i in xrange(n):
+        start = timer()
+        op()
+        times.append(timer() - start)
+    total = sum(times)
+    times.sort()
+    retained = measureRetained(op, max(1, n // 10))
+    return {'ops': n / total if total else float('inf'),
+            'p50': percentile(times, 0.50) * 1e6,
+            'p99': percentile(times, 0.99) * 1e6,
+            'retained': retained}
+
+def compare(result, base, tolerance):
+    """Relative change of ops/sec to the baseline and whether it's a regression"""
+    change = (result['ops'] - base['ops']) / base['ops']
+    return change, change < -tolerance
+
+def main(args):
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+
+    results = {}
+    regressions = []
+    print "%-44s %12s %10s %10s %12s %9s" % ("benchmark", "ops/sec", "p50 us", "p99 us", "retained/op", "vs base")
+    for name, makeOp in benchmarks:
+        if args.k and args.k.lower() not in name.lower():
+            continue
+        r = run(name, makeOp, args.n)
+        results[name] = r
+        versus = "-"
+        if name in baseline:
+            change, regressed = compare(r, baseline[name], args.tolerance)
+            versus = "%+.1f%%" % (change * 100)
+            if regressed:
+                versus += " !"
+                regressions.append(name)
+        print "%-44s %12.1f %10.1f %10.1f %12.2f %9s" % (name, r['ops'], r['p50'], r['p99'],
+                r['retained'], versus)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as handle:
+            json.dump(baseline, handle, indent=2, sort_keys=True)
+        print "baseline saved to %s" % args.baseline
+    if regressions:
+        print "slower than baseline by more than %d%%: %s" % (args.tolerance * 100, ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="boxbot microbenchmarks")
+    parser.add_argument("-n", type=int, default=1000, help="timed operations per benchmark")
+    parser.add_argument("-k", help="run only benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=defaultBaseline, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+            help="ops/sec drop counted as a regression (default 0.10)")
+    sys.exit(main(parser.parse_args()))
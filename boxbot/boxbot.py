@@ -13,20 +13,25 @@ import logging
 log = logging.getLogger(__name__)
 
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol, task, defer, threads
+from twisted.internet import reactor, protocol, defer
 
 import sys
+import time
+import fnmatch
 import argparse
-import yaml
 
 # commands
 import command
+import outbound
+import classifier
+import channel
+import hub
+import metrics
+import profiler
+import configfile
 
 # custom modules
-import rssfeed
 import urltitle
-import updatenotifier
-import twitter
 
 # todo: features:
 # * a fully fledged command parser
@@ -44,70 +49,178 @@ class CoreCommands:
         self.bot = bot
         self.bot.registerModule(self.moduleName, self)
 
-    @command.command("core", ['quit'])
+    @command.command("core", ['quit'], prefix=False)
     def quit(self, tokens, **kwargs):
         log.info("bot received a quitting command")
         self.bot.quit("Awww.")
 
     @command.command("core", ['silence'])
     def silence(self, tokens, **kwargs):
-        log.info("silencing bot")
-        self.bot.announceAllowed = False
+        log.info("silencing bot on %s", kwargs['channel'])
+        self.bot.channelFor(kwargs['channel']).announceAllowed = False
+        self.bot.saveState()
 
     @command.command("core", ['unsilence'])
     def unsilence(self, tokens, **kwargs):
-        log.info("unsilencing bot")
-        self.bot.announceAllowed = True
+        log.info("unsilencing bot on %s", kwargs['channel'])
+        self.bot.channelFor(kwargs['channel']).announceAllowed = True
+        self.bot.saveState()
+
+    @command.command("core", ['stats'])
+    def stats(self, tokens, **kwargs):
+        """Tells how the bot is doing: refresh times, queues, latencies..."""
+        for line in metrics.registry.summary():
+            self.bot.announce(line, channel=kwargs['channel'], source='stats')
+
+    @command.command("core", ['profile'], admin=True, prefix=False)
+    def profile(self, tokens, **kwargs):
+        """Profiles the bot for a while: profile [seconds (default 30) | stop]"""
+        c = kwargs['channel']
+        prof = self.bot.factory.hub.profiler
+        if len(tokens) > 1 and tokens[1] == 'stop':
+            prof.stop()
+            return
+        try:
+            seconds = int(tokens[1]) if len(tokens) > 1 else 30
+        except ValueError:
+            seconds = 0
+        if seconds <= 0:
+            self.bot.announce("Usage: profile [seconds | stop]", channel=c)
+            return
+        try:
+            d = prof.start(seconds)
+        except profiler.ProfilerBusy:
+            self.bot.announce("Already profiling!", channel=c)
+            return
+        self.bot.announce("Profiling for %d seconds..." % min(seconds, prof.maxSeconds), channel=c)
+
+        def report((path, top)):
+            self.bot.announce("Profile written to " + path + ", most time spent in:", channel=c)
+            for line in top:
+                self.bot.announce(line, channel=c, source='profile')
+        d.addCallbacks(report, lambda e: self.bot.announce("Aww, profiling failed.", channel=c))
+
+    @command.command("core", ['reload-config'], admin=True, prefix=False)
+    def reloadConfig(self, tokens, **kwargs):
+        """Reads the config file again and applies it without reconnecting"""
+        c = kwargs['channel']
+        try:
+            report = self.bot.factory.hub.reloadConfig()
+        except configfile.ConfigError as e:
+            self.bot.announce("Not reloading, the config is bad: " + str(e), channel=c)
+            return
+        self.bot.announce("Config reloaded: " + "; ".join(report), channel=c)
 
     @command.command("core", ['help'])
     def help(self, tokens, **kwargs):
         log.info("bot received an introduce command. proceeding...")
-        self.bot.announce("HELLOOO")
-        self.bot.announce("boxbot-" + self.bot.factory.config['build'] + ", command with 'boxbot: <commandstr>'")
-        self.bot.announce("You can get list of commands by calling me with 'list-commands'")
-        self.bot.announce("contact maus if I'm too terrible and break something.")
+        c = kwargs['channel']
+        self.bot.announce("HELLOOO", channel=c)
+        self.bot.announce("boxbot-" + self.bot.factory.config.get('build', 'dev') + ", command with 'boxbot: <commandstr>'", channel=c)
+        self.bot.announce("You can get list of commands by calling me with 'list-commands'", channel=c)
+        self.bot.announce("contact maus if I'm too terrible and break something.", channel=c)
 
     @command.command("core", ['list-commands'])
     def listCommands(self, tokens, **kwargs):
         log.info("bot asked to list commands")
-        for m in command.allCommands:
+        modules = self.bot.commands.byModule()
+        for m in sorted(modules):
             s = "Module: " + m + "; commands: "
-            s += ", ".join(command.allCommands[m].keys())
-            self.bot.announce(s)
+            s += ", ".join(sorted(modules[m]))
+            self.bot.announce(s, channel=kwargs['channel'])
 
 
 class Bot(irc.IRCClient):
     """A protocol object (our 'bot') for IRC'ing"""
 
     # settings
-    lineRate = 1
+    # no rate limiting in IRCClient: the outbound scheduler does it
+    lineRate = None
     maxWAnnounce = 4
-    doneWAnnounce = 0
+    # titles of at most this many urls per message
+    maxUrls = 5
 
     willAuth = True
 
     hasQuit = False
-    announceAllowed = True
 
     # "AI"
     awws = 0
     maxAwws = 3
-    cachedTopic = None
 
     # command stuff; TODO move this elsewhere
     commandDelimiters = [':', ',']
 
-    regModules = {}
+    # counters and switches that survive reconnects and restarts
+    # (per channel ones are in channel.Channel)
+    persistentState = ('awws',)
 
 
     def __init__(self, factory):
         self.factory = factory
         self.nickname = self.factory.config['nickname']
         self.realname = self.factory.config['realname']
+        self.commands = command.CommandIndex()
+        for alias, keyword in self.factory.config.get('aliases', {}).iteritems():
+            self.commands.alias(alias, keyword)
+        self.updateClassifier()
+        self.loadState()
+        outboundConfig = self.factory.config.get('outbound', {})
+        self.outbound = outbound.OutboundScheduler(self.say, outboundConfig.get('burst'),
+                outboundConfig.get('rate'), outboundConfig.get('maxLineLength'))
         self.commandCore = CoreCommands(self)
+        # the shared modules
+        self.factory.hub.attach(self)
 
     def registerModule(self, module, instance):
-        self.regModules[module] = instance
+        self.commands.register(module, instance)
+
+    def updateClassifier(self):
+        """'nick:' and the like are compiled into the line classifier;
+        recompiled only when our nick changes"""
+        self.classifier = classifier.Classifier(self.nickname, self.commandDelimiters)
+
+    def nickChanged(self, nick):
+        irc.IRCClient.nickChanged(self, nick)
+        self.updateClassifier()
+
+    def reconfigure(self, oldConfig, joined, parted):
+        """Take the reloaded network config of the factory: join and part
+        channels, change nick, aliases and outbound limits"""
+        config = self.factory.config
+        for name in parted:
+            self.leave(name, "Reconfigured.")
+        for name in joined:
+            self.join(name)
+        if config['nickname'] != oldConfig['nickname']:
+            self.setNick(config['nickname'])
+        if config.get('aliases') != oldConfig.get('aliases'):
+            self.commands.aliases = dict(config.get('aliases', {}))
+            self.commands.rebuild()
+        outboundConfig = config.get('outbound', {})
+        self.outbound.burst = outboundConfig.get('burst', outbound.OutboundScheduler.burst)
+        self.outbound.rate = outboundConfig.get('rate', outbound.OutboundScheduler.rate)
+        self.outbound.maxLineLength = outboundConfig.get('maxLineLength',
+                outbound.OutboundScheduler.maxLineLength)
+
+    def loadState(self):
+        saved = self.factory.hub.stateStore.get('core', self.factory.stateKey('bot'), {})
+        for k in self.persistentState:
+            if k in saved:
+                setattr(self, k, saved[k])
+
+    def saveState(self):
+        self.factory.hub.stateStore.put('core', self.factory.stateKey('bot'),
+                dict((k, getattr(self, k)) for k in self.persistentState))
+        self.factory.saveChannels()
+
+    def channelFor(self, name):
+        """Our Channel of the name, or None if we're not on it"""
+        return self.factory.channels.get(name.lower())
+
+    def channelsFor(self, source):
+        """Channels subscribed to notifications from source"""
+        return [c for c in self.factory.channels.itervalues() if c.subscribes(source)]
 
     def connectionMade(self):
         irc.IRCClient.connectionMade(self)
@@ -117,12 +230,16 @@ class Bot(irc.IRCClient):
     def connectionLost(self, reason):
         irc.IRCClient.connectionLost(self, reason)
         log.info("connection lost: %s", reason)
+        self.outbound.stop()
+        self.factory.hub.detach(self)
 
     def signedOn(self):
         """Called when bot has successfully connected to a server."""
         log.info("signed on.")
+        # the server may have given us an alternative nick
+        self.updateClassifier()
 
-        if self.willAuth:
+        if self.willAuth and self.factory.quakeConfig:
             # if we're on quakenet... well, for now we're are, but TODO: check!!
             log.info("we're on quakenet and authenticating...")
             self.mode(self.nickname, True, "x")     # set user mode +x
@@ -130,30 +247,36 @@ class Bot(irc.IRCClient):
             self.msg("Q@CServe.quakenet.org", "AUTH %s %s" %
                     (self.factory.quakeConfig['authName'], self.factory.quakeConfig['authPass']))
 
-        # join the channel
-        self.join(self.factory.channel)
+        # join the channels
+        for c in self.factory.channels.itervalues():
+            self.join(c.name)
 
     def joined(self, channel):
         log.info("successfully joined the channel: %s", channel)
-        self.cachedOp = False
-        if not self.factory.feedMonitor.isRunning:
+        chan = self.channelFor(channel)
+        if chan:
+            chan.cachedOp = False
+        monitor = self.factory.hub.feedMonitor
+        if monitor and not monitor.isRunning:
             log.info("starting feed monitor...")
-            self.factory.feedMonitor.start()
+            monitor.resume()
 
     def modeChanged(self, user, channel, setted, modes, args):
         log.debug("noticed mode change: %s, %s, %s, %s, %s"
                 % (user, channel, setted, modes, args))
-        if channel == self.factory.channel:
+        chan = self.channelFor(channel)
+        if chan:
             if self.nickname in args:
                 log.info("bot mode changed by %s. set: %s modes: %s"
                         % (user, str(setted), modes))
                 if 'o' in modes:
-                    self.cachedOp = setted
+                    chan.cachedOp = setted
                     log.debug("bot op mode changed: %s", setted)
             if 'o' in modes and setted:
                 # reset wantAnnounce counter if bot sees someone to get ops
                 log.debug("resetting doneWAnnounce counter...")
-                self.doneWAnnounce = 0
+                chan.doneWAnnounce = 0
+                self.saveState()
 
     def topicUpdated(self, user, channel, newTopic):
         """In channel, user changed the topic to newTopic.
@@ -161,90 +284,138 @@ class Bot(irc.IRCClient):
         Also called when first joining a channel."""
 
         log.info("%s topic updated by %s: %s" % (channel, user, newTopic))
-        self.cachedTopic = newTopic
+        chan = self.channelFor(channel)
+        if chan:
+            chan.cachedTopic = newTopic
         # joined the channel and got a topic: start monitoring the feed
 
 
-    def urlfetcher(self, msg):
-
-        def titleAnnounce(titletext):
-            log.info("channel patron posted an url, announcing title")
-            self.announce(titletext)
-
-        log.debug("bot to determine if privmsg an url")
-        url = urltitle.parseUrl(msg)
-        if url:
-            d = threads.deferToThread(urltitle.fetchTitle, url)
+    def lookupTitle(self, url):
+        """Deferred title text of the url (None if it can't be had);
+        from the title cache if possible"""
+        cache = self.factory.hub.titleCache
+        registry = metrics.registry
+
+        def titleFetched((titletext, finalUrl)):
+            registry.histogram('boxbot_title_fetch_seconds', "time to fetch a url title").observe(
+                    time.time() - started)
+            cache.put(url, titletext, finalUrl)
+            return titletext
+
+        def titleFailed(e):
+            log.error("couldn't fetch title of %s, %s", url, e.getErrorMessage())
+            registry.counter('boxbot_title_fetch_errors_total', "failed title fetches").inc()
+            cache.putFailure(url)
+            return None
+
+        cached = cache.get(url)
+        if cached:
+            registry.counter('boxbot_title_cache_hits_total', "titles found in the cache").inc()
+            if not cached.title:
+                log.debug("not fetching %s, it failed recently", url)
+            return defer.succeed(cached.title)
+        started = time.time()
+        d = self.factory.hub.titleFetcher.fetch(url)
+        d.addCallbacks(titleFetched, titleFailed)
+        return d
+
+    def urlfetcher(self, matches, channel):
+        """Announce on channel the titles of urls found by the classifier"""
+
+        def titleAnnounce(titles):
+            titles = [t for t in titles if t]
+            if titles:
+                log.info("channel patron posted %d urls, announcing titles", len(titles))
+                self.announce(" | ".join(titles), channel=channel, priority=outbound.NOTICE, source='urltitle')
+
+        urls = urltitle.collectUrls(matches, self.factory.hub.urltitleConfig.get('maxUrls', self.maxUrls))
+        if urls:
+            # all titles of the message in one line
+            d = defer.gatherResults([self.lookupTitle(url) for url in urls])
             d.addCallback(titleAnnounce)
-            d.addErrback(lambda e: log.error("couldn't fetch title, %s", e))
+            d.addErrback(lambda e: log.error("couldn't announce titles, %s", e))
 
     def privmsg(self, user, channel, msg):
         """This will get called when the bot receives a message"""
         log.debug("bot received a message: %s: %s: %s" % (channel, user, msg))
 
+        chan = self.channelFor(channel)
+        if not chan:
+            return
         msg = msg.decode('utf-8')
-
-        self.urlfetcher(msg)
-
-        def notValidCommand():
-            self.announce("You must provide me a valid command!")
-
-        accepted = [self.nickname + d for d in self.commandDelimiters]
-        if channel == self.factory.channel and msg.startswith(tuple(accepted)):
-            commandTokens = msg.split()
-            if len(commandTokens) < 2:
-                notValidCommand()
-                return
-            key = commandTokens[1]
-            # stupid debug stuff
-            log.debug('Trying to dechiper ' + key)
-            for mod in command.allCommands:
-                if key in command.allCommands[mod]:
-                    # maybe something more Twisted would more apt? meh
-                    fun = command.allCommands[mod][key]
-                    log.debug('Calling fun ' + str(fun))
-                    fun(self.regModules[mod], commandTokens[1:], user=user, channel=channel, msg=msg)
-                    return
-            notValidCommand()
-        elif self.nickname in msg:
-            self.announceAww()
-
-        # TODO re-implement this using new command API
-        #    elif parseBotCmd("next update"):
-        #        log.info("bot asked to retrieve time until the next comic update")
-        #        self.factory.comicNotifier.askedNextUpdateWith(msg)
+        tags = self.classifier.classify(msg)
+
+        if classifier.URL in tags and self.factory.hub.titleFetcher and chan.subscribes('urltitle'):
+            self.urlfetcher(tags.urls, chan.name)
+
+        if classifier.COMMAND in tags:
+            self.dispatchCommand(user, chan.name, msg)
+        elif classifier.MENTION in tags:
+            self.announceAww(chan.name)
+
+    def dispatchCommand(self, user, channel, msg):
+        commandTokens = msg.split()
+        if len(commandTokens) < 2:
+            self.announce("You must provide me a valid command!", channel=channel)
+            return
+        entry = self.commands.lookup(commandTokens[1])
+        if not entry:
+            self.announce("You must provide me a valid command!", channel=channel)
+            return
+        if entry.meta.get('admin') and not self.isAdmin(user):
+            log.info("%s not allowed to use %s", user, entry.keyword)
+            self.announce("Aww, only admins can do that.", channel=channel)
+            return
+        # maybe something more Twisted would more apt? meh
+        log.debug('Calling %s.%s', entry.module, entry.keyword)
+        started = time.time()
+        entry.handler(commandTokens[1:], user=user, channel=channel, msg=msg, bot=self)
+        metrics.registry.histogram('boxbot_command_seconds', "time to run a command handler",
+                {'command': entry.keyword}).observe(time.time() - started)
+
+    def isAdmin(self, user):
+        """Does nick!user@host match a pattern in the 'admins' config?"""
+        return any(fnmatch.fnmatch(user, pattern) for pattern in self.factory.config.get('admins', []))
 
     def action(self, user, channel, data):
+        chan = self.channelFor(channel)
+        if not chan:
+            return
         data = data.decode('utf-8')
+        tags = self.classifier.classify(data)
 
-        self.urlfetcher(data)
+        if classifier.URL in tags and self.factory.hub.titleFetcher and chan.subscribes('urltitle'):
+            self.urlfetcher(tags.urls, chan.name)
 
-        if channel == self.factory.channel and self.nickname in data:
-            if "fish" in data or "trout" in data or "large" in data:
-                if "slaps" in data:
-                    self.describe(self.factory.channel, "slaps " + user + " with a large HELLOOO-OOO....")
+        if classifier.MENTION in tags:
+            if classifier.FISH in tags:
+                if classifier.SLAPS in tags:
+                    self.outbound.enqueue(chan.name,
+                            "slaps " + user + " with a large HELLOOO-OOO....", sendFn=self.describe)
             else:
-                self.announceAww()
+                self.announceAww(chan.name)
 
     # commands that monitor should be able to use
-    def announceAww(self):
+    def announceAww(self, channel):
             log.info("bot called, responding with aww")
             self.awws += 1
             if self.awws < self.maxAwws:
-                self.announce("Awww.")
+                self.announce("Awww.", channel=channel)
             else:
-                self.announce("Awww. (Help available by calling me with 'boxbot: help')")
+                self.announce("Awww. (Help available by calling me with 'boxbot: help')", channel=channel)
                 self.awws = 0
+            self.saveState()
 
     def quit(self, msg):
-        """Disconnect from network"""
+        """Disconnect from all networks and shut down"""
+        self.factory.hub.quit(msg)
+
+    def disconnect(self, msg):
+        """Disconnect from this network"""
         self.hasQuit = True
-        log.info("bot quitting (with message %s). stopping heartbeat...", msg)
+        log.info("bot quitting %s (with message %s). stopping heartbeat...", self.factory.name, msg)
         self.stopHeartbeat()
-        log.info("stopping feedmonitor...")
-        self.factory.feedMonitor.stop()
         irc.IRCClient.quit(self, msg)
-        sys.exit()
 
     def applyColorFormat(self, *msg, **kwargs):
         """put some nice colors on the message"""
@@ -274,89 +445,148 @@ class Bot(irc.IRCClient):
         return irc.assembleFormattedText(irc.attributes.normal[toAssemble])
 
     def announce(self, *msg, **kwargs):
-        """Announce a message (or a message consisting of multiple parts) to channel.
+        """Announce a message (or a message consisting of multiple parts) to
+        a channel, or to every channel subscribed to its source.
 
         Optionally, one can specify special colors (or other irc effects) for
         each part of the msg by providing a tuple of valid twisted irc
         attributes (or None for those parts where the default format should be
-        applied)"""
+        applied)
+
+        The message goes to the given channel; without one, it's fanned out
+        to the channels subscribed to the source (all channels if there's
+        no source either). It is queued with the given priority
+        (outbound.REPLY by default); messages with a source can be coalesced
+        into digest lines."""
         specialColors = kwargs.get('specialColors')
-        if self.announceAllowed:
-            colored = self.applyColorFormat(*msg, colors=specialColors)
-            self.say(self.factory.channel, colored)
-            log.info("bot announced: %s", msg)
+        source = kwargs.get('source')
+        if kwargs.get('channel'):
+            targets = [self.channelFor(kwargs['channel'])]
         else:
-            log.info("announce called but bot is silenced")
-
-    def announceWant(self, topic):
+            targets = self.channelsFor(source)
+        colored = None
+        for chan in targets:
+            if not chan or not chan.announceAllowed:
+                log.info("announce called but bot is silenced (or not on the channel)")
+                continue
+            if colored is None:
+                colored = self.applyColorFormat(*msg, colors=specialColors)
+            self.outbound.enqueue(chan.name, colored,
+                    kwargs.get('priority', outbound.REPLY), source)
+            log.info("bot announced on %s: %s", chan.name, msg)
+
+    def announceWant(self, topic, channel):
         log.info("announceWant called")
+        chan = self.channelFor(channel)
         # timer: actually announce the want only N times
-        if self.doneWAnnounce <= self.maxWAnnounce:
+        if chan.doneWAnnounce <= self.maxWAnnounce:
             log.debug("announcement counter ok, making an announcement")
-            self.announce("wants to set topic to ", topic, specialColors=(None, irc.attributes.fg.blue))
-            self.doneWAnnounce += 1
+            self.announce("wants to set topic to ", topic, specialColors=(None, irc.attributes.fg.blue),
+                    channel=channel, priority=outbound.TOPIC)
+            chan.doneWAnnounce += 1
+            self.saveState()
 
-    def setTopic(self, topic):
+    def setTopic(self, topic, channel):
         """Set the channel topic"""
         # check if opp'd, then set, otherwise, complain
-        log.info("bot asked to set topic")
-        if self.cachedOp:
+        log.info("bot asked to set topic of %s", channel)
+        if self.channelFor(channel).cachedOp:
             log.info("bot setting topic to: %s", topic)
-            self.topic(self.factory.channel, topic.encode('utf-8'))
+            self.outbound.enqueue(channel, topic.encode('utf-8'),
+                    outbound.TOPIC, sendFn=self.topic)
         else:
             log.info("bot thinks it's not able to set topic")
-            self.announceWant(topic)
+            self.announceWant(topic, channel)
 
-    def getTopic(self):
+    def getTopic(self, channel):
         """Get the channel topic"""
-        if self.cachedTopic:
-            return self.cachedTopic
+        chan = self.channelFor(channel)
+        if chan and chan.cachedTopic:
+            return chan.cachedTopic
         else:
             return ""
 
 
 class BotFactory(protocol.ReconnectingClientFactory):
-    """A factory for Bots"""
+    """A factory for the Bots of one network"""
+
+    bot = None
 
-    def __init__(self, config):
-        """Initializing the factory"""
+    def __init__(self, config, sharedHub = None):
+        """Initializing the factory
+
+        config is the config of the network (see hub.parseNetworks), or a
+        whole single network config; the subsystems of sharedHub are used
+        if given, otherwise the factory has a hub of its own."""
+        if 'host' not in config:
+            config = hub.parseNetworks(config)[0]
         self.config = config
-        self.channel = config['channel']
-        self.rssConfig = config['rss']
-        self.quakeConfig = config['quakeAuth']
-        self.notifyConfig = config['notifyComics']
-        self.twitterConfig = config['twitter']
-        # pass the config to feed monitor
-        log.debug("bot factory initilized")
+        self.name = config['name']
+        self.hub = sharedHub
+        if self.hub is None:
+            self.hub = hub.Hub(config)
+        self.quakeConfig = config.get('quakeAuth')
+        self.channels = channel.parseChannels(config)
+        for c in self.channels.itervalues():
+            c.restore(self.hub.stateStore.get('core', self.stateKey('channel:' + c.name), {}))
+        self.hub.factories.append(self)
+        log.debug("bot factory for %s initilized", self.name)
+
+    def reconfigure(self, config):
+        """Take a reloaded network config, keeping the connection; returns
+        lines telling what changed"""
+        oldConfig, self.config = self.config, config
+        label = self.name or config['host']
+        report = []
+        if (oldConfig['host'], oldConfig['port']) != (config['host'], config['port']):
+            report.append("%s: the new server address takes a restart" % label)
+        self.quakeConfig = config.get('quakeAuth')
+        channels = channel.parseChannels(config)
+        for key, c in channels.iteritems():
+            if key in self.channels:
+                # keep the topic, op and silence state
+                self.channels[key].subscriptions = c.subscriptions
+                channels[key] = self.channels[key]
+            else:
+                c.restore(self.hub.stateStore.get('core', self.stateKey('channel:' + c.name), {}))
+        joined = [c.name for key, c in channels.iteritems() if key not in self.channels]
+        parted = [c.name for key, c in self.channels.iteritems() if key not in channels]
+        self.channels = channels
+        if joined or parted:
+            report.append("%s: joining %s, leaving %s" % (label,
+                ", ".join(joined) or "none", ", ".join(parted) or "none"))
+        if self.bot and self.bot in self.hub.bots:
+            self.bot.reconfigure(oldConfig, joined, parted)
+        return report
+
+    def stateKey(self, key):
+        """State store key of this network (unprefixed without a network name)"""
+        if self.name:
+            return self.name + '/' + key
+        return key
+
+    def saveChannels(self):
+        for c in self.channels.itervalues():
+            self.hub.stateStore.put('core', self.stateKey('channel:' + c.name), c.snapshot())
 
     def startFactory(self):
         """This will be called before I begin listening on a Port or Connector."""
         log.debug("factory starting")
-        pass
 
     def stopFactory(self):
         """Called before stopping listening on all Ports/Connectors. """
         log.debug("factory stopping")
+        self.hub.stateStore.flush()
 
     def buildProtocol(self, addr):
         """Create an instance of a subclass of Protocol."""
         log.debug("build protocol called: building bot.")
         # successfully connected, create the bot
+        # the shared modules (feed monitor, tweets...) outlive the bots;
+        # the hub only attaches them to the new one
         p = Bot(self)
         self.bot = p
 
-        # attach external modules:
-        # start monitoring the feed with a Monitor;
-        # provide it with a bot to manipulate
-        log.debug("creating a feed monitor with a bot...")
-        self.feedMonitor = rssfeed.Monitor(self.rssConfig, p)
-        # start the comic update notifier clock thingy, and provide it a bot too:
-        log.debug("creating a comic update time notifier")
-        self.comicNotifier = updatenotifier.Notifier(self.notifyConfig, p)
-
-        log.debug("creating a twitter feed listener")
-        self.tweetListener = twitter.IRCListener(self.twitterConfig, p)
-
         # reset reconnection delay
         self.resetDelay()
         return p
@@ -365,8 +595,9 @@ class BotFactory(protocol.ReconnectingClientFactory):
         """Connection lost, if not quitting, reconnect."""
         log.info("connection lost (%s)" % reason)
         if self.bot.hasQuit:
-            log.info("quitting: stopping reactor")
-            reactor.stop()
+            if reactor.running:
+                log.info("quitting: stopping reactor")
+                reactor.stop()
         else:
             log.info("reconnect via parent...")
             protocol.ReconnectingClientFactory.clientConnectionLost(self,
@@ -377,40 +608,30 @@ class BotFactory(protocol.ReconnectingClientFactory):
         protocol.ReconnectingClientFactory.clientConnectionFailed(self,
                 connector, reason)
 
-def readConfig(configFile):
-    try:
-        with open(configFile) as handle:
-            config = yaml.load(handle)
-    except IOError:
-        log.error("could not open %s" % (configFile))
-        raise
-    log.debug("config file read successfully")
-    return config
-
 def main(args):
     log.info("-"*10)
     log.info("entered main")
 
     # reading from yaml config file
     try:
-        config = readConfig(args.config)
-        # !!! config file is not validated!
-        # wrong syntax etc can cause problems
-    except Exception as e:
-        log.error("reading config file failed. terminating...")
+        config = configfile.loadChecked(args.config)
+    except configfile.ConfigError as e:
+        log.error("reading config file failed (%s). terminating...", e)
         sys.exit(1)
 
-    factory = BotFactory(config)
-
-    host, port = config['network']['host'], config['network']['port']
+    # one hub of shared subsystems for the connections to all networks
+    sharedHub = hub.Hub(config, args.config)
+    sharedHub.start()
     log.debug("got config")
-    log.debug("...connection details: %s:%d, channel %s" % (host, port, config['channel']))
-    log.debug("...rss details: %s, delay %d sec" 
-            % (config['rss']['url'], config['rss']['freq']))
+    log.debug("...rss details: %s" % config.get('rss'))
     log.debug("...comic-notify details: TODO")
 
-    log.info("connecting to %s:%d" % (host, port))
-    reactor.connectTCP(host, port, factory)
+    for network in hub.parseNetworks(config):
+        factory = BotFactory(network, sharedHub)
+        host, port = network['host'], network['port']
+        log.debug("...connection details: %s:%d, channels %s" % (host, port, factory.channels.keys()))
+        log.info("connecting to %s:%d" % (host, port))
+        reactor.connectTCP(host, port, factory)
     reactor.run()
 
 if __name__ == "__main__":
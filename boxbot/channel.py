@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+"""
+channel module
+
+Per-channel state of the bot: topic, op status, silence, and which
+notifications the channel is subscribed to.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import collections
+
+# subscription names: notification sources, plus the topic updates
+TOPIC = 'topic'
+
+
+class Channel(object):
+    """
+    A channel the bot sits on.
+
+    subscriptions is a set of notification sources ('rssfeed', 'twitter',
+    'urltitle', 'topic' for the feed-driven topic...); None subscribes to
+    everything.
+    """
+
+    # switches that survive reconnects and restarts
+    persistentState = ('announceAllowed', 'doneWAnnounce')
+
+    def __init__(self, name, subscriptions = None):
+        self.name = name
+        self.subscriptions = None
+        if subscriptions is not None:
+            self.subscriptions = set(subscriptions)
+        self.cachedTopic = None
+        self.cachedOp = False
+        self.announceAllowed = True
+        self.doneWAnnounce = 0
+
+    def subscribes(self, source):
+        """Does the channel get notifications from source (None: any)?"""
+        return source is None or self.subscriptions is None or source in self.subscriptions
+
+    def snapshot(self):
+        return dict((k, getattr(self, k)) for k in self.persistentState)
+
+    def restore(self, snapshot):
+        for k in self.persistentState:
+            if k in snapshot:
+                setattr(self, k, snapshot[k])
+
+
+def parseChannels(config):
+    """
+    Channels of a config by lowercased name, in order: 'channels' is a
+    list of {name: ..., subscribe: [...]}; the old 'channel: name' is a
+    channel subscribed to everything.
+    """
+    channels = collections.OrderedDict()
+    if 'channels' in config:
+        for c in config['channels']:
+            channels[c['name'].lower()] = Channel(c['name'], c.get('subscribe'))
+    else:
+        channels[config['channel'].lower()] = Channel(config['channel'])
+    return channels
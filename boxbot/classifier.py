@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+classifier module
+
+Tags incoming channel lines (urls, commands, mentions, slaps...) in one
+pass, so that the bot can route them to the right handlers.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import re
+
+import urltitle
+
+# tags
+URL = 'url'
+COMMAND = 'command'
+MENTION = 'mention'
+SLAPS = 'slaps'
+FISH = 'fish'
+
+
+class Classification(object):
+    """Tags found in a line, and the urls in it"""
+
+    __slots__ = ('tags', 'urls')
+
+    def __init__(self):
+        self.tags = set()
+        self.urls = []
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+
+class Classifier(object):
+    """
+    All triggers compiled into one alternation of named groups; one
+    finditer over a line finds every trigger in it.
+
+    triggers is a list of (tag, pattern) in order of precedence; patterns
+    get the bot's nickname as {nick} and the command delimiters as
+    {delimiters}. A command is only recognized at the start of a line.
+    """
+
+    triggers = [
+        (COMMAND, r'\A{nick}[{delimiters}]'),
+        (URL, urltitle.urlsRe),
+        (MENTION, r'{nick}'),
+        (SLAPS, r'slaps'),
+        (FISH, r'fish|trout|large'),
+    ]
+
+    def __init__(self, nickname, delimiters):
+        self.compile(nickname, delimiters)
+
+    def compile(self, nickname, delimiters):
+        """(Re)build the pattern, e.g. when the nickname changes"""
+        params = {'nick': re.escape(nickname),
+                'delimiters': ''.join(re.escape(d) for d in delimiters)}
+        self.pattern = re.compile('|'.join('(?P<%s>%s)' % (tag, p.format(**params))
+                for tag, p in self.triggers))
+        log.debug("classifier compiled for %s", nickname)
+
+    def classify(self, line):
+        c = Classification()
+        for m in self.pattern.finditer(line):
+            tag = m.lastgroup
+            c.tags.add(tag)
+            if tag == URL:
+                c.urls.append(m.group(0))
+        return c
@@ -1,8 +1,10 @@
-
 # -*- coding: utf-8 -*-
 
 """
 a utility module for updatenotifier
+
+Schedules are {weekday (0 is monday): datetime.time} in UTC; times are
+handled as offsets (seconds) from the start of the week.
 """
 
 
@@ -10,35 +12,69 @@ import logging
 
 log = logging.getLogger(__name__)
 
+import bisect
 import datetime
 
-def findNextWeekDay(comic_schedule, currentUTCtime):
-    d = currentUTCtime.weekday()
-    cur_diff, cur = 7, None
-    for k in comic_schedule.keys():
-        if k > 0 and k - d > 0 and k - d < cur_diff:
-            cur_diff, cur = k - d, k
-        elif k < d and 7 + k - d > 0 and 7 + k - d < cur_diff:
-            cur_diff, cur = 7 + k - d, k
-        elif k - d == 0:
-            # the same day! clearly the min can't be less
-            # but we should check if it's after or befor
-            if currentUTCtime.time() < comic_schedule[k]:
-                return k
-    if cur == 7:
-        log.error("error in finding next weekday: cur was not set!")
-    return cur
-
-def calculateDiff(currentUTCtime, next_day, schedule):
-    day = currentUTCtime.weekday()
-    if next_day >= day:
-        diff = datetime.timedelta(next_day - day)
-    else:
-        diff = datetime.timedelta(next_day + 7 - day)
-
-    next_timedate = datetime.datetime.combine(currentUTCtime.date() + diff, 
-            schedule[next_day])
-    return  next_timedate - currentUTCtime
+DAY = 24 * 60 * 60
+WEEK = 7 * DAY
+
+
+def weekOffset(when):
+    """Seconds from the start of the week (monday 00:00) to a datetime"""
+    return (when.weekday() * DAY + when.hour * 3600 + when.minute * 60 + when.second
+            + when.microsecond / 1e6)
+
+
+class Timeline(object):
+    """
+    The weekly updates of all comics as one sorted list of (offset,
+    comic); the next update after a moment, of any comic or of one, is
+    found by bisecting.
+    """
+
+    def __init__(self, comics):
+        """comics is {comic: schedule}"""
+        events = sorted((day * DAY + t.hour * 3600 + t.minute * 60 + t.second, comic)
+                for comic, schedule in comics.iteritems() for day, t in schedule.iteritems())
+        self.offsets = [offset for offset, comic in events]
+        self.comics = [comic for offset, comic in events]
+        self.byComic = {}
+        for offset, comic in events:
+            self.byComic.setdefault(comic, []).append(offset)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def nextAfter(self, offset, comic = None):
+        """
+        (offset, [comics]) of the next update strictly after offset, of
+        the comic or of any comic (all the comics updating then); the
+        offset is past the end of offset's week if the update is on the
+        next week. None if there are no updates.
+        """
+        offsets = self.offsets if comic is None else self.byComic.get(comic, [])
+        if not offsets:
+            return None
+        weekStart = offset - offset % WEEK
+        i = bisect.bisect_right(offsets, offset % WEEK)
+        if i == len(offsets):
+            i = 0
+            weekStart += WEEK
+        nextOffset = offsets[i]
+        if comic is not None:
+            return weekStart + nextOffset, [comic]
+        last = bisect.bisect_right(self.offsets, nextOffset, i)
+        return weekStart + nextOffset, self.comics[i:last]
+
+    def timeUntil(self, when, comic = None):
+        """timedelta from a datetime to the next update of the comic (or any),
+        None if there are none"""
+        now = weekOffset(when)
+        upcoming = self.nextAfter(now, comic)
+        if upcoming is None:
+            return None
+        return datetime.timedelta(seconds=upcoming[0] - now)
+
 
 def prettify(timedelta):
     output = ""
@@ -50,7 +86,7 @@ def prettify(timedelta):
     if h > 1:
         output += str(h) + " hours, "
     elif h == 1:
-        output += "1 hour and "
+        output += "1 hour, "
     m = (timedelta.seconds - 60*60*h) // 60
     if m > 1:
         output += str(m) + " minutes, "
@@ -59,8 +95,8 @@ def prettify(timedelta):
     output += str(timedelta.seconds - 60*60*h - 60*m ) + " seconds"
     return output
 
-def timeUntilNextUpdate(comic_schedule):
+def timeUntilNextUpdate(comic_schedule, currentUTCtime = None):
     log.info("calculator called")
-    currentUTCtime = datetime.datetime.utcnow()
-    day = findNextWeekDay(comic_schedule, currentUTCtime)
-    return prettify(calculateDiff(currentUTCtime, day, comic_schedule))
+    if currentUTCtime is None:
+        currentUTCtime = datetime.datetime.utcnow()
+    return prettify(Timeline({None: comic_schedule}).timeUntil(currentUTCtime))
@@ -6,6 +6,8 @@ Provides a rudimentary user command api.
 * A decorator thingy that can be used in modules to register user commands.
 
 * Dict based module - command hierarchy
+
+* A flat keyword -> bound handler index for dispatching
 """
 
 import logging
@@ -15,7 +17,7 @@ log = logging.getLogger(__name__)
 
 allCommands = {}
 
-def command(module, keywords):
+def command(module, keywords, **meta):
     """Decorator that provides command interface for bot modules.
 
     Usage:
@@ -36,8 +38,14 @@ def command(module, keywords):
     :keywords: list of command strings; each word consists of string of
     non-whitespace (all text after first whitespace (if any) will be dropped
     silently)
+    :meta: per-command metadata, e.g. admin=True; 'help' defaults to the
+    first line of the docstring; prefix=False makes the command answer only
+    to its full keyword (or an alias), for commands too drastic to guess
     """
     def decorator(f):
+        f.commandMeta = dict(meta)
+        if 'help' not in meta and f.__doc__:
+            f.commandMeta['help'] = f.__doc__.strip().split('\n')[0]
         if module not in allCommands:
             allCommands[module] = {}
             log.debug('Created a new module hierarchy in allCommands: %s', module)
@@ -47,3 +55,88 @@ def command(module, keywords):
             log.debug('Added a new command function: %s', f)
         return f
     return decorator
+
+
+class CommandEntry(object):
+    """A resolved command: the keyword, its module, the handler bound to the
+    module instance and the metadata given to the decorator"""
+
+    __slots__ = ('keyword', 'module', 'function', 'handler', 'meta')
+
+    def __init__(self, keyword, module, function, instance):
+        self.keyword = keyword
+        self.module = module
+        self.function = function
+        self.handler = function.__get__(instance, instance.__class__)
+        self.meta = function.commandMeta
+
+
+class CommandIndex(object):
+    """
+    Dispatch index of the commands of registered module instances.
+
+    Keywords (and aliases) map straight to CommandEntries, and so do the
+    unambiguous prefixes of keywords ('list' for 'list-commands', if no
+    other command starts with it), unless the command is marked
+    prefix=False. The index is rebuilt only when a module registers or an
+    alias is added; lookups are a dict probe or two.
+    """
+
+    def __init__(self):
+        self.modules = {}
+        self.aliases = {}
+        self.index = {}
+        self.prefixes = {}
+
+    def register(self, module, instance):
+        self.modules[module] = instance
+        self.rebuild()
+
+    def unregister(self, module):
+        if self.modules.pop(module, None) is not None:
+            self.rebuild()
+
+    def alias(self, alias, keyword):
+        """Make alias another keyword for the command keyword"""
+        self.aliases[alias] = keyword
+        self.rebuild()
+
+    def rebuild(self):
+        index = {}
+        for module, instance in self.modules.iteritems():
+            for keyword, f in allCommands.get(module, {}).iteritems():
+                index[keyword] = CommandEntry(keyword, module, f, instance)
+        for alias, keyword in self.aliases.iteritems():
+            if keyword in index:
+                index[alias] = index[keyword]
+            else:
+                log.debug("alias %s for a command not (yet) registered: %s", alias, keyword)
+
+        # prefix -> entry; None if the prefix could mean several commands
+        prefixes = {}
+        for keyword, entry in index.iteritems():
+            if not entry.meta.get('prefix', True):
+                continue
+            for i in range(1, len(keyword)):
+                prefix = keyword[:i]
+                other = prefixes.get(prefix, entry)
+                if other is not None and other.function is not entry.function:
+                    other = None
+                prefixes[prefix] = other
+        self.index = index
+        self.prefixes = prefixes
+        log.debug("command index rebuilt: %d keywords", len(index))
+
+    def lookup(self, word):
+        """CommandEntry for a keyword, alias or unambiguous prefix, or None"""
+        entry = self.index.get(word)
+        if entry is None:
+            entry = self.prefixes.get(word)
+        return entry
+
+    def byModule(self):
+        """{module: [keywords]} of the registered commands"""
+        modules = {}
+        for keyword, entry in self.index.iteritems():
+            modules.setdefault(entry.module, []).append(keyword)
+        return modules
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""
+configfile module
+
+Reading, checking and comparing the yaml config, for startup and for
+reloading it in a running bot.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import yaml
+
+import plugins
+
+
+class ConfigError(Exception):
+    pass
+
+
+def readConfig(configFile):
+    try:
+        with open(configFile) as handle:
+            config = yaml.load(handle)
+    except IOError:
+        log.error("could not open %s" % (configFile))
+        raise
+    log.debug("config file read successfully")
+    return config
+
+def loadChecked(configFile):
+    """readConfig and validate; anything wrong is raised as a ConfigError"""
+    try:
+        config = readConfig(configFile)
+    except (IOError, yaml.YAMLError) as e:
+        raise ConfigError("can't read %s: %s" % (configFile, e))
+    validate(config)
+    return config
+
+def mtime(configFile):
+    return os.path.getmtime(configFile)
+
+def validate(config):
+    """Raise a ConfigError telling what's wrong with the config, if anything"""
+    problems = []
+    if not isinstance(config, dict):
+        raise ConfigError("the config is not a mapping")
+    for key in ('nickname', 'realname'):
+        if not config.get(key):
+            problems.append("%s missing" % key)
+
+    if 'networks' in config:
+        networks = config['networks']
+        if not isinstance(networks, list) or not networks:
+            problems.append("networks is not a list of networks")
+            networks = []
+    elif 'network' in config:
+        networks = [config['network']]
+    else:
+        networks = []
+        problems.append("network missing")
+    for n in networks:
+        if not isinstance(n, dict) or 'host' not in n or 'port' not in n:
+            problems.append("a network without host and port")
+        elif 'channel' in n or 'channels' in n:
+            problems.extend(channelProblems(n))
+    if 'channel' in config or 'channels' in config:
+        problems.extend(channelProblems(config))
+    elif not all(isinstance(n, dict) and ('channel' in n or 'channels' in n) for n in networks):
+        problems.append("channel missing")
+
+    if plugins.enabled(config, 'rss'):
+        rss = config['rss']
+        feeds = rss.get('feeds', [rss])
+        if not isinstance(feeds, list):
+            problems.append("rss feeds is not a list of feeds")
+            feeds = []
+        elif not feeds:
+            problems.append("rss feeds is empty")
+        for f in feeds:
+            if not isinstance(f, dict) or not f.get('url'):
+                problems.append("an rss feed without url")
+            elif not isinstance(f.get('freq', rss.get('freq')), (int, float)) or \
+                    f.get('freq', rss.get('freq')) <= 0:
+                problems.append("rss feed %s has no positive freq" % f['url'])
+    if plugins.enabled(config, 'twitter'):
+        twitter = config['twitter']
+        auth = twitter.get('auth') or {}
+        for key in ('consumer_key', 'consumer_secret', 'access_token', 'access_token_secret'):
+            if key not in auth:
+                problems.append("twitter auth %s missing" % key)
+        if not isinstance(twitter.get('follow'), list):
+            problems.append("twitter follow is not a list")
+    if plugins.enabled(config, 'notifyComics'):
+        notify = config['notifyComics']
+        if not isinstance(notify.get('comics'), dict):
+            problems.append("notifyComics comics missing")
+        elif not all(isinstance(s, dict) and s for s in notify['comics'].itervalues()):
+            problems.append("notifyComics has a comic without an update schedule")
+        elif notify.get('defaultComic') not in notify['comics']:
+            problems.append("notifyComics defaultComic is not one of the comics")
+
+    if problems:
+        raise ConfigError("; ".join(problems))
+
+def channelProblems(config):
+    if 'channels' in config:
+        if not isinstance(config['channels'], list) or \
+                not all(isinstance(c, dict) and c.get('name') for c in config['channels']):
+            return ["channels is not a list of {name: ...}"]
+    elif not config.get('channel'):
+        return ["channel is empty"]
+    return []
+
+def diff(old, new):
+    """Top level sections that differ between two configs"""
+    return set(k for k in set(old) | set(new) if old.get(k) != new.get(k))
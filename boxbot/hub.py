@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+hub module
+
+The subsystems shared by the connections to all networks: the modules
+(feed monitor, tweets...), url titles and the state store. One feed
+refresh or tweet is announced through every connected bot.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import sys
+import collections
+
+from twisted.internet import reactor, task
+
+import statestore
+import titlecache
+import urltitle
+import metrics
+import profiler
+import plugins
+import configfile
+
+
+def parseNetworks(config):
+    """
+    Per network configs: the top level config updated with each entry of
+    'networks' ({name:, host:, port:, and e.g. nickname:, channels:,
+    quakeAuth: of its own}). The old single 'network: {host:, port:}' is
+    a network without a name.
+    """
+    if 'networks' not in config:
+        net = dict(config)
+        net['name'] = None
+        net.update(config['network'])
+        return [net]
+    networks = []
+    for n in config['networks']:
+        net = dict(config)
+        net.update(n)
+        net.setdefault('name', n['host'])
+        networks.append(net)
+    return networks
+
+
+class Hub(object):
+    """
+    Owns the shared subsystems and knows the connected bots.
+
+    Modules get the hub as their bot: they are attached to every bot
+    (see lifecycle.Module), and what they announce goes through all the
+    connected bots (each picks its own subscribed channels).
+    """
+
+    # sections that are only read when starting
+    restartSections = ('state', 'processPool', 'metrics')
+
+    def __init__(self, config, configPath = None):
+        """configPath is the file config was read from, for reloading"""
+        self.config = config
+        self.configPath = configPath
+        self.configMtime = None
+        self.configWatch = None
+        self.bots = []
+        # the BotFactories, one per network; connected or not
+        self.factories = []
+        # optional worker processes for parsing; forked before the reactor runs
+        self.parsePool = None
+        poolConfig = config.get('processPool')
+        if poolConfig:
+            import procpool
+            self.parsePool = procpool.ProcessPool(poolConfig.get('processes'),
+                    poolConfig.get('maxQueued'), poolConfig.get('timeout'))
+        self.urltitleConfig = config.get('urltitle', {})
+        cacheConfig = self.urltitleConfig.get('cache', {})
+        self.titleCache = titlecache.TitleCache(cacheConfig.get('maxEntries'),
+                cacheConfig.get('ttl'), cacheConfig.get('negativeTtl'), cacheConfig.get('path'),
+                cacheConfig.get('flushInterval'))
+        self.titleFetcher = None
+        if self.urltitleConfig.get('enabled', True):
+            self.titleFetcher = self.makeTitleFetcher(self.urltitleConfig)
+        # state outlives the bots (and, with a path, the process)
+        stateConfig = config.get('state', {})
+        self.stateStore = statestore.StateStore(stateConfig.get('path'),
+                stateConfig.get('flushInterval'))
+        # {name: module} of the configured modules
+        self.modules = plugins.load(config, self)
+        self.feedMonitor = self.modules.get('rssfeed')
+        self.profiler = profiler.Profiler(config.get('profiler', {}).get('directory'))
+        metrics.registry.gauge('boxbot_outbound_queued', "lines waiting to be sent, all networks",
+                fn=lambda: sum(bot.outbound.depth() for bot in self.bots))
+        metrics.registry.gauge('boxbot_threadpool_queued', "jobs waiting for a reactor pool thread",
+                fn=lambda: reactor.getThreadPool().q.qsize())
+        metrics.registry.gauge('boxbot_threadpool_working', "busy reactor pool threads",
+                fn=lambda: len(reactor.getThreadPool().working))
+        metrics.registry.gauge('boxbot_bots_connected', "connected networks",
+                fn=lambda: len(self.bots))
+        log.debug("hub created")
+
+    def makeTitleFetcher(self, urltitleConfig):
+        """Reactor-native fetcher by default, 'engine: thread' for the old way"""
+        if urltitleConfig.get('engine', 'agent') == 'thread':
+            return urltitle.ThreadedTitleFetcher(urltitleConfig.get('maxBytes'))
+        return urltitle.TitleFetcher(urltitleConfig.get('maxConcurrent'),
+                urltitleConfig.get('perHost'), urltitleConfig.get('timeout'),
+                urltitleConfig.get('maxBytes'), self.parsePool)
+
+    def start(self):
+        """Start the state store and title cache writes, the modules (e.g.
+        the single twitter stream) and the metrics endpoint, if there's one"""
+        self.stateStore.start()
+        self.titleCache.start()
+        metricsConfig = self.config.get('metrics')
+        if metricsConfig:
+            port = metrics.serve(metrics.registry, metricsConfig.get('port', 9109),
+                    metricsConfig.get('interface', '127.0.0.1'))
+            log.info("serving metrics on %s", port.getHost())
+        for m in self.modules.itervalues():
+            m.start()
+        # 'reloadInterval: seconds' polls the config file for changes
+        interval = self.config.get('reloadInterval')
+        if interval and self.configPath:
+            self.configMtime = configfile.mtime(self.configPath)
+            self.configWatch = task.LoopingCall(self.checkConfig)
+            self.configWatch.start(interval, now=False)
+
+    def checkConfig(self):
+        """Reload the config if the file has changed"""
+        try:
+            mtime = configfile.mtime(self.configPath)
+        except OSError as e:
+            log.warning("can't check the config file: %s", e)
+            return
+        if mtime == self.configMtime:
+            return
+        self.configMtime = mtime
+        log.info("config file changed, reloading")
+        try:
+            for line in self.reloadConfig():
+                log.info("config reload: %s", line)
+        except configfile.ConfigError as e:
+            log.error("not reloading the config: %s", e)
+
+    def reloadConfig(self):
+        """
+        Read the config file again and apply what changed without
+        reconnecting: modules are reconfigured in place (or loaded,
+        replaced, unloaded), the networks get their new channels, nick,
+        aliases, admins and outbound limits, and url titles a new fetcher.
+        Returns lines telling what was done.
+
+        Raises ConfigError, changing nothing, if the new config is bad.
+        """
+        if not self.configPath:
+            raise configfile.ConfigError("no config file to reload")
+        config = configfile.loadChecked(self.configPath)
+        changed = configfile.diff(self.config, config)
+        if not changed:
+            return ["nothing changed"]
+        log.info("config sections changed: %s", ", ".join(sorted(changed)))
+        self.config = config
+        report = []
+        for section, (name, make) in plugins.registry.iteritems():
+            if section in changed:
+                try:
+                    report.append(self.reloadModule(section, name, make))
+                except Exception as e:
+                    log.exception("reloading %s failed", name)
+                    report.append("%s not reloaded: %s" % (name, e))
+        self.feedMonitor = self.modules.get('rssfeed')
+        if 'urltitle' in changed:
+            self.urltitleConfig = config.get('urltitle', {})
+            if self.titleFetcher:
+                self.titleFetcher.close()
+            self.titleFetcher = None
+            if self.urltitleConfig.get('enabled', True):
+                self.titleFetcher = self.makeTitleFetcher(self.urltitleConfig)
+            report.append("url titles reconfigured")
+        if 'profiler' in changed:
+            self.profiler.directory = config.get('profiler', {}).get('directory') or '.'
+        networks = dict((n['name'], n) for n in parseNetworks(config))
+        for factory in self.factories:
+            if factory.name in networks:
+                report.extend(factory.reconfigure(networks.pop(factory.name)))
+            else:
+                report.append("network %s is gone, disconnect it with a restart" % factory.name)
+        for name in networks:
+            report.append("network %s is new, connect to it with a restart" % name)
+        for section in self.restartSections:
+            if section in changed:
+                report.append("%s changes take a restart" % section)
+        return report
+
+    def reloadModule(self, section, name, make):
+        """Apply a changed module section: reconfigure the module if it can,
+        otherwise replace it; or load or unload it"""
+        current = self.modules.get(name)
+        if not plugins.enabled(self.config, section):
+            if current is None:
+                return "%s stays disabled" % name
+            self.unloadModule(name)
+            return "%s unloaded" % name
+        sectionConfig = self.config[section]
+        if current is not None and current.reconfigure(sectionConfig):
+            return "%s reconfigured" % name
+        module = make(self, sectionConfig)
+        if current is not None:
+            self.unloadModule(name)
+        self.modules[name] = module
+        self.modules = collections.OrderedDict((n, self.modules[n])
+                for n, make in plugins.registry.itervalues() if n in self.modules)
+        module.start()
+        for bot in self.bots:
+            module.attach(bot)
+        if current is not None:
+            return "%s replaced" % name
+        return "%s loaded" % name
+
+    def unloadModule(self, name):
+        module = self.modules.pop(name)
+        module.stop()
+        for bot in self.bots:
+            module.detach(bot)
+
+    def attach(self, bot):
+        """A bot (protocol) was built: attach the modules to it"""
+        self.bots.append(bot)
+        for m in self.modules.itervalues():
+            m.attach(bot)
+        log.info("%d bots connected", len(self.bots))
+
+    def detach(self, bot):
+        """The connection of a bot was lost"""
+        if bot in self.bots:
+            self.bots.remove(bot)
+            for m in self.modules.itervalues():
+                m.detach(bot)
+
+    def announce(self, *msg, **kwargs):
+        """Announce through every connected bot"""
+        for bot in self.bots:
+            bot.announce(*msg, **kwargs)
+
+    def subscribers(self, source):
+        """(bot, channel) of every channel subscribed to source"""
+        return [(bot, chan) for bot in self.bots for chan in bot.channelsFor(source)]
+
+    def quit(self, msg):
+        """Disconnect from every network and close the shared things"""
+        if self.configWatch and self.configWatch.running:
+            self.configWatch.stop()
+        log.info("stopping modules...")
+        for m in self.modules.itervalues():
+            m.stop()
+        for bot in list(self.bots):
+            bot.disconnect(msg)
+        log.info("saving state...")
+        self.stateStore.close()
+        self.titleCache.close()
+        if self.titleFetcher:
+            self.titleFetcher.close()
+        if self.parsePool:
+            self.parsePool.close()
+        sys.exit()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""
+lifecycle module
+
+The steps a bot module goes through. Modules are owned by the hub and
+outlive the connections: their fetchers, caches and streams survive
+reconnects, and a reconnect only attaches them to the new bot.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Module(object):
+    """
+    Base of the modules owned by the hub:
+
+    start()       once, when the hub starts (before connecting)
+    attach(bot)   for every bot (protocol) built; registers the commands
+    detach(bot)   when the bot's connection is lost (or the module is
+                  unloaded); unregisters the commands
+    stop()        once, when the bot quits; closes streams etc.
+
+    reconfigure(sectionConfig) takes a reloaded config section in place
+    and returns True; if it returns False, the hub replaces the module
+    with a new one (stop, detach, then start and attach the new one).
+    """
+
+    moduleName = None
+
+    # the hub, which modules announce through
+    bot = None
+
+    def start(self):
+        pass
+
+    def attach(self, bot):
+        if self.moduleName:
+            bot.registerModule(self.moduleName, self)
+
+    def detach(self, bot):
+        if self.moduleName:
+            bot.commands.unregister(self.moduleName)
+
+    def reconfigure(self, sectionConfig):
+        return False
+
+    def stop(self):
+        pass
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+metrics module
+
+Counters, gauges and histograms of what the bot is doing (feed refresh
+times, queue depths, title latencies...). Shown by the 'stats' command
+and, optionally, served over http in the Prometheus text format.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import bisect
+import collections
+
+# histogram bucket bounds (seconds) for latencies
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n = 1):
+        self.value += n
+
+    def samples(self):
+        return [('', {}, self.value)]
+
+
+class Gauge(object):
+    """A value that's set, or read from fn when sampled"""
+    kind = 'gauge'
+
+    def __init__(self, fn = None):
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def read(self):
+        if self.fn:
+            try:
+                return self.fn()
+            except Exception as e:
+                log.debug("reading a gauge failed: %s", e)
+                return float('nan')
+        return self.value
+
+    def samples(self):
+        return [('', {}, self.read())]
+
+
+class Histogram(object):
+    """Observations counted in cumulative buckets, plus their count and sum"""
+    kind = 'histogram'
+
+    def __init__(self, buckets = None):
+        self.buckets = tuple(buckets or defaultBuckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def samples(self):
+        samples = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            samples.append(('_bucket', {'le': repr(bound)}, cumulative))
+        samples.append(('_bucket', {'le': '+Inf'}, self.count))
+        samples.append(('_sum', {}, self.sum))
+        samples.append(('_count', {}, self.count))
+        return samples
+
+
+class Registry(object):
+    """
+    Metrics by name and labels. counter(), gauge() and histogram() return
+    the existing metric of the name and labels, or register a new one.
+    """
+
+    def __init__(self):
+        # name -> (kind, help, {labels tuple: metric})
+        self.families = collections.OrderedDict()
+
+    def counter(self, name, help = '', labels = None):
+        return self._get(name, help, labels, Counter)
+
+    def gauge(self, name, help = '', labels = None, fn = None):
+        g = self._get(name, help, labels, Gauge)
+        if fn is not None:
+            g.fn = fn
+        return g
+
+    def histogram(self, name, help = '', labels = None, buckets = None):
+        return self._get(name, help, labels, lambda: Histogram(buckets))
+
+    def _get(self, name, help, labels, make):
+        if name not in self.families:
+            self.families[name] = (None, help, collections.OrderedDict())
+        kind, help, metrics = self.families[name]
+        key = tuple(sorted((labels or {}).items()))
+        if key not in metrics:
+            metrics[key] = make()
+            self.families[name] = (metrics[key].kind, help, metrics)
+        return metrics[key]
+
+    def render(self):
+        """The Prometheus text exposition format"""
+        lines = []
+        for name, (kind, help, metrics) in self.families.iteritems():
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for key, metric in metrics.iteritems():
+                for suffix, extra, value in metric.samples():
+                    labels = list(key) + sorted(extra.items())
+                    labelText = ''
+                    if labels:
+                        labelText = '{%s}' % ','.join('%s="%s"' % (k, escapeLabel(v)) for k, v in labels)
+                    lines.append("%s%s%s %s" % (name, suffix, labelText, formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Short human readable lines, one per metric family"""
+        lines = []
+        for name, (kind, help, metrics) in self.families.iteritems():
+            if kind == 'histogram':
+                count = sum(m.count for m in metrics.itervalues())
+                total = sum(m.sum for m in metrics.itervalues())
+                mean = total / count if count else 0.0
+                slowest = max(m.mean() for m in metrics.itervalues())
+                lines.append("%s: %d, avg %.3f, worst avg %.3f" % (name, count, mean, slowest))
+            elif kind == 'counter':
+                lines.append("%s: %d" % (name, sum(m.value for m in metrics.itervalues())))
+            else:
+                lines.append("%s: %s" % (name, ', '.join(formatValue(m.read()) for m in metrics.itervalues())))
+        return lines
+
+
+def escapeLabel(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatValue(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+
+def serve(registry, port, interface):
+    """Serve a registry in the text format over http, for scraping;
+    returns the listening port (twisted.web is imported only if used)"""
+    from twisted.internet import reactor
+    from twisted.web import server, resource
+
+    class MetricsResource(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('content-type', 'text/plain; version=0.0.4')
+            return registry.render()
+    return reactor.listenTCP(port, server.Site(MetricsResource()), interface=interface)
+
+
+# the registry of the process
+registry = Registry()
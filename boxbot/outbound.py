@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+outbound module
+
+Schedules the lines the bot sends: replies to commands go first, then
+topic changes, then notifications (feed posts, tweets, url titles).
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import collections
+
+from twisted.internet import reactor
+
+import metrics
+
+# priority classes, most urgent first
+REPLY = 0
+TOPIC = 1
+NOTICE = 2
+PRIORITIES = (REPLY, TOPIC, NOTICE)
+
+
+class OutboundItem(object):
+    """Queued text parts for a target; parts of the same source coalesce"""
+
+    __slots__ = ('priority', 'target', 'parts', 'sendFn', 'key')
+
+    def __init__(self, priority, target, parts, sendFn, key):
+        self.priority = priority
+        self.target = target
+        self.parts = parts
+        self.sendFn = sendFn
+        self.key = key
+
+
+class OutboundScheduler(object):
+    """
+    Priority queues drained at the rate the server allows.
+
+    The server's flood protection is modelled with a token bucket: burst
+    lines can be sent back to back, after that rate lines per second.
+    Text queued with a source is appended to a still queued item of the
+    same source, priority and target, and sent as digest lines of at most
+    maxLineLength bytes joined with separator.
+    """
+
+    burst = 4
+    rate = 0.5
+    maxLineLength = 400
+    separator = " | "
+
+    def __init__(self, send, burst = None, rate = None, maxLineLength = None, clock = reactor):
+        """send(target, line) sends a line, unless an item has its own sendFn"""
+        if burst is not None:
+            self.burst = burst
+        if rate is not None:
+            self.rate = rate
+        if maxLineLength is not None:
+            self.maxLineLength = maxLineLength
+        self.send = send
+        self.clock = clock
+        self.queues = dict((p, collections.deque()) for p in PRIORITIES)
+        self.coalescing = {}
+        self.tokens = self.burst
+        self.lastRefill = clock.seconds()
+        self.pending = None
+        self.sentLines = metrics.registry.counter('boxbot_outbound_lines_total', "lines sent")
+
+    def enqueue(self, target, text, priority = REPLY, source = None, sendFn = None):
+        """Queue text for target"""
+        key = None
+        if source is not None:
+            key = (priority, source, target)
+            item = self.coalescing.get(key)
+            if item is not None:
+                log.debug("coalescing a line from %s", source)
+                item.parts.append(text)
+                return
+        item = OutboundItem(priority, target, [text], sendFn or self.send, key)
+        self.queues[priority].append(item)
+        if key:
+            self.coalescing[key] = item
+        self._schedule()
+
+    def depth(self):
+        """Number of queued items"""
+        return sum(len(q) for q in self.queues.itervalues())
+
+    def stop(self):
+        """Drop everything queued"""
+        if self.pending and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+        for q in self.queues.itervalues():
+            q.clear()
+        self.coalescing.clear()
+
+    def _schedule(self):
+        # drain on the next reactor iteration, so that a burst queued in
+        # one go gets coalesced and ordered by priority first
+        if self.pending is None:
+            self.pending = self.clock.callLater(0, self._drain)
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+
+    def _drain(self):
+        self.pending = None
+        self._refill()
+        while self.tokens >= 1:
+            item = self._next()
+            if item is None:
+                return
+            self._sendLine(item)
+            self.tokens -= 1
+        if self.depth():
+            self.pending = self.clock.callLater((1 - self.tokens) / self.rate, self._drain)
+
+    def _next(self):
+        for p in PRIORITIES:
+            if self.queues[p]:
+                return self.queues[p][0]
+        return None
+
+    def _sendLine(self, item):
+        """Send the first (digest) line of the item at the head of its queue"""
+        line = item.parts[0]
+        used = 1
+        for part in item.parts[1:]:
+            if len(line) + len(self.separator) + len(part) > self.maxLineLength:
+                break
+            line += self.separator + part
+            used += 1
+        del item.parts[:used]
+        if not item.parts:
+            self.queues[item.priority].popleft()
+            if item.key:
+                del self.coalescing[item.key]
+        self.sentLines.inc()
+        item.sendFn(item.target, line)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+"""
+plugins module
+
+The optional bot modules by config section. A module (and whatever it
+depends on: feedparser, tweepy...) is imported and created only if its
+section is in the config and not disabled with 'enabled: false'.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import collections
+
+
+def makeMonitor(hub, config):
+    import rssfeed
+    return rssfeed.Monitor(config, hub, stateStore=hub.stateStore, parsePool=hub.parsePool)
+
+def makeNotifier(hub, config):
+    import updatenotifier
+    return updatenotifier.Notifier(config, hub)
+
+def makeTweetListener(hub, config):
+    import twitter
+    return twitter.IRCListener(config, hub, hub.stateStore)
+
+# config section -> (module name, function making the module of the hub)
+registry = collections.OrderedDict([
+    ('rss', ('rssfeed', makeMonitor)),
+    ('notifyComics', ('updatenotifier', makeNotifier)),
+    ('twitter', ('twitter', makeTweetListener)),
+])
+
+
+def enabled(config, section):
+    """Is a (module or other optional) section of the config enabled?"""
+    sectionConfig = config.get(section)
+    if not sectionConfig:
+        return False
+    return not isinstance(sectionConfig, dict) or sectionConfig.get('enabled', True)
+
+def load(config, hub):
+    """{module name: module} of the enabled sections, in registry order"""
+    modules = collections.OrderedDict()
+    for section, (name, make) in registry.iteritems():
+        if enabled(config, section):
+            log.debug("loading the %s module", name)
+            modules[name] = make(hub, config[section])
+        else:
+            log.debug("%s not configured, not loading it", name)
+    return modules
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+procpool module
+
+CPU-bound parsing (feeds, html) in worker processes, off the GIL the
+reactor and the fetch threads share.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import multiprocessing
+
+from twisted.internet import reactor, defer, threads, task
+
+import metrics
+
+
+class ProcessError(Exception):
+    """A job raised in a worker process, took too long or its worker died"""
+
+
+def _run(fn, args):
+    # in a worker: exceptions don't cross the pool in python 2, results do
+    try:
+        return True, fn(*args)
+    except Exception as e:
+        return False, "%s: %s" % (e.__class__.__name__, e)
+
+
+class ProcessPool(object):
+    """
+    A multiprocessing.Pool with results as Deferreds.
+
+    At most maxQueued jobs are handed to the pool at a time, the rest wait
+    (in the reactor) for a slot. Jobs are module level functions and
+    their arguments and results must be picklable.
+
+    The pool never finishes a job whose worker died (crash, OOM kill),
+    so a job fails with ProcessError after timeout seconds, and the jobs
+    in the workers are failed when a dead worker is noticed (checked every
+    checkInterval seconds); either way its slot is freed.
+    """
+
+    maxQueued = 16
+    timeout = 60
+    checkInterval = 5
+
+    def __init__(self, processes = None, maxQueued = None, timeout = None):
+        """processes: the number of workers, the number of cores by default"""
+        if maxQueued is not None:
+            self.maxQueued = maxQueued
+        if timeout is not None:
+            self.timeout = timeout
+        self.pool = multiprocessing.Pool(processes)
+        self.slots = defer.DeferredSemaphore(self.maxQueued)
+        # job id -> (Deferred, timeout DelayedCall) of the jobs in the pool
+        self.jobs = {}
+        self.nextJob = 0
+        self.workerPids = self._workerPids()
+        self.checker = task.LoopingCall(self.checkWorkers)
+        self.checker.start(self.checkInterval, now=False)
+        metrics.registry.gauge('boxbot_procpool_waiting', "parse jobs waiting for a worker slot",
+                fn=lambda: len(self.slots.waiting))
+        log.debug("a process pool created (%d queued at most)", self.maxQueued)
+
+    def submit(self, fn, *args):
+        """Deferred result of fn(*args) run in a worker; call in the reactor"""
+        return self.slots.run(self._submit, fn, args)
+
+    def apply(self, fn, *args):
+        """fn(*args) run in a worker; call from a thread, blocks it until done"""
+        return threads.blockingCallFromThread(reactor, self.submit, fn, *args)
+
+    def close(self):
+        if self.checker.running:
+            self.checker.stop()
+        self.pool.terminate()
+        # don't leave threads blocked in apply()
+        for job in list(self.jobs):
+            self._fail(job, "the pool was closed")
+
+    def checkWorkers(self):
+        """Fail the jobs in the pool if a worker has died; the pool replaces
+        the worker, but the job it had is lost (and we can't tell which)"""
+        pids = self._workerPids()
+        if not self.workerPids <= pids:
+            log.error("a parse worker died, failing %d jobs in the pool", len(self.jobs))
+            metrics.registry.counter('boxbot_procpool_worker_deaths_total',
+                    "parse worker processes that died").inc()
+            for job in list(self.jobs):
+                self._fail(job, "a worker process died")
+        self.workerPids = pids
+
+    def _workerPids(self):
+        return set(p.pid for p in self.pool._pool if p.exitcode is None)
+
+    def _submit(self, fn, args):
+        d = defer.Deferred()
+        job = self.nextJob
+        self.nextJob += 1
+        self.jobs[job] = (d, reactor.callLater(self.timeout, self._fail, job,
+            "no result in %d seconds" % self.timeout))
+
+        def done((ok, result)):
+            # called in the pool's result thread
+            reactor.callFromThread(self._finish, job, ok, result)
+        self.pool.apply_async(_run, (fn, args), callback=done)
+        return d
+
+    def _finish(self, job, ok, result):
+        if job not in self.jobs:
+            # failed already
+            return
+        d, timeout = self.jobs.pop(job)
+        timeout.cancel()
+        if ok:
+            d.callback(result)
+        else:
+            d.errback(ProcessError(result))
+
+    def _fail(self, job, reason):
+        if job not in self.jobs:
+            return
+        d, timeout = self.jobs.pop(job)
+        if timeout.active():
+            timeout.cancel()
+        log.error("parse job failed: %s", reason)
+        d.errback(ProcessError(reason))
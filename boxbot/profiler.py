@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+profiler module
+
+Profiles the live bot for a while: cProfile is enabled in the reactor
+thread (where privmsg, announcing and the feed callbacks run), the stats
+are dumped to a file for pstats / snakeviz and the hottest functions are
+told back.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import os
+import time
+import cProfile
+import pstats
+
+from twisted.internet import reactor, defer
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Profiler(object):
+    """One profiling run at a time, stopped after a while or on demand"""
+
+    # longest allowed run, seconds
+    maxSeconds = 600
+
+    def __init__(self, directory = None, clock = reactor):
+        self.directory = directory or '.'
+        self.clock = clock
+        self.profile = None
+        self.finished = None
+        self.timeout = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self, seconds):
+        """Deferred firing with (stats file, top functions) when stopped"""
+        if self.running:
+            raise ProfilerBusy("already profiling")
+        if seconds <= 0:
+            raise ValueError("profiling time must be positive")
+        seconds = min(seconds, self.maxSeconds)
+        # the timer first: if it can't be set, nothing is left half started
+        timeout = self.clock.callLater(seconds, self.stop)
+        self.profile = cProfile.Profile()
+        self.finished = defer.Deferred()
+        self.timeout = timeout
+        log.info("profiling for %d seconds", seconds)
+        self.profile.enable()
+        return self.finished
+
+    def stop(self):
+        if not self.running:
+            return
+        self.profile.disable()
+        if self.timeout.active():
+            self.timeout.cancel()
+        path = os.path.join(self.directory, time.strftime('boxbot-%Y%m%d-%H%M%S.prof'))
+        profile, finished = self.profile, self.finished
+        self.profile = self.finished = self.timeout = None
+        try:
+            profile.dump_stats(path)
+            log.info("profile written to %s", path)
+            finished.callback((path, topFunctions(pstats.Stats(profile))))
+        except Exception as e:
+            log.error("writing the profile failed: %s", e)
+            finished.errback(e)
+
+
+def topFunctions(stats, n = 5):
+    """'12.3% name (file:line)' of the n functions with the most own time"""
+    total = stats.total_tt or 1.0
+    rows = sorted(stats.stats.iteritems(), key=lambda (func, s): s[2], reverse=True)[:n]
+    return ["%.1f%% %s (%s:%d)" % (100.0 * s[2] / total, name, os.path.basename(filename), line)
+            for (filename, line, name), s in rows]
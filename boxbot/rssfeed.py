@@ -8,11 +8,25 @@ import logging
 log = logging.getLogger(__name__)
 
 import feedparser
+import requests
+import hashlib
 import re
+import urlparse
+import fractions
+import calendar
+import time
+import collections
+import email.utils
+from xml.etree import cElementTree
 
-from twisted.internet import task, reactor, threads
+from twisted.internet import task, reactor, threads, defer
 
 from command import command
+import statestore
+import outbound
+import channel
+import metrics
+import lifecycle
 
 # todo:
 #  * use deferreds properly?
@@ -37,37 +51,263 @@ class TopicStatus:
         elif self.comicId == irctopic.comicId:
             return self.text != irctopic.text
 
+class ThreadRecord(object):
+    """What is remembered of a forum thread: id, time of the last post
+    (epoch seconds) and the last poster"""
+
+    __slots__ = ('threadId', 'timestamp', 'postby')
+
+    def __init__(self, threadId, timestamp, postby):
+        self.threadId = threadId
+        self.timestamp = timestamp
+        self.postby = postby
+
+
+class ThreadStore(object):
+    """
+    Bounded memory of the threads seen in one feed, keyed by thread id.
+
+    Threads are kept in order of their last update; the least recently
+    updated ones are evicted when there are more than maxSize of them or
+    their last post is older than maxAge seconds. The horizon is the newest
+    timestamp evicted so far: an unknown thread that is not newer than
+    that has been seen (and forgotten) already; newest is the timestamp
+    of the latest post seen.
+    """
+
+    maxSize = 5000
+    maxAge = 60 * 24 * 60 * 60
+
+    def __init__(self, maxSize = None, maxAge = None):
+        if maxSize is not None:
+            self.maxSize = maxSize
+        if maxAge is not None:
+            self.maxAge = maxAge
+        self.records = collections.OrderedDict()
+        self.horizon = 0
+        self.newest = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, threadId):
+        return self.records.get(threadId)
+
+    def update(self, threadId, timestamp, postby):
+        """Store (or refresh) a thread as the most recently updated one"""
+        self.records.pop(threadId, None)
+        self.records[threadId] = ThreadRecord(threadId, timestamp, postby)
+        self.newest = max(self.newest, timestamp)
+
+    def isNew(self, threadId, timestamp):
+        """Has the thread a post we haven't seen?"""
+        record = self.records.get(threadId)
+        if record:
+            return timestamp > record.timestamp
+        return timestamp > self.horizon
+
+    def evict(self, now):
+        """Forget threads over the size bound and those too old"""
+        while len(self.records) > self.maxSize:
+            self._forget()
+        oldest = now - self.maxAge
+        while self.records and next(self.records.itervalues()).timestamp < oldest:
+            self._forget()
+        self.horizon = max(self.horizon, oldest)
+
+    def _forget(self):
+        threadId, record = self.records.popitem(last=False)
+        self.horizon = max(self.horizon, record.timestamp)
+
+    def snapshot(self):
+        return {'horizon': self.horizon,
+                'threads': [[r.threadId, r.timestamp, r.postby] for r in self.records.itervalues()]}
+
+    def restore(self, snapshot):
+        for threadId, timestamp, postby in snapshot['threads']:
+            self.update(threadId, timestamp, postby)
+        self.horizon = snapshot['horizon']
+
+
+class StreamEntry(object):
+    """The fields of a feed item the monitor needs, as read by iterItems"""
+
+    __slots__ = ('link', 'title', 'published_parsed', 'summary', 'postby', 'recentlink')
+
+    def __init__(self, link, title, published_parsed, summary):
+        self.link = link
+        self.title = title
+        self.published_parsed = published_parsed
+        self.summary = summary
+
+    def get(self, key, default = None):
+        """Like the dict access of feedparser entries"""
+        return getattr(self, key, default)
+
+
+def parseDate(text):
+    """RFC 822 date (as in RSS pubDate) to a UTC struct_time, or None"""
+    parsed = email.utils.parsedate_tz(text or '')
+    if parsed is None:
+        return None
+    return time.gmtime(email.utils.mktime_tz(parsed))
+
+maxAgePat = re.compile(r'max-age\s*=\s*(\d+)')
+ttlPat = re.compile(r'<ttl>\s*(\d+)\s*</ttl>')
+
+def pollHint(headers):
+    """Seconds the server asks us not to poll again for (0 if it doesn't
+    say): Cache-Control max-age, or Retry-After in seconds or as a date"""
+    hint = 0
+    m = maxAgePat.search(headers.get('cache-control', ''))
+    if m:
+        hint = int(m.group(1))
+    retryAfter = (headers.get('retry-after') or '').strip()
+    if retryAfter.isdigit():
+        hint = max(hint, int(retryAfter))
+    elif retryAfter:
+        parsed = email.utils.parsedate_tz(retryAfter)
+        if parsed:
+            hint = max(hint, email.utils.mktime_tz(parsed) - time.time())
+    return hint
+
+def rssTtl(content):
+    """The <ttl> (minutes) of an RSS channel in seconds, 0 if there's none;
+    it's in the channel header, so only the start of the document is read"""
+    m = ttlPat.search(content, 0, 8192)
+    if m:
+        return int(m.group(1)) * 60
+    return 0
+
+def parseEntries(content, headers):
+    """feedparser entries of a feed document (module level, so that it can
+    run in a procpool worker)"""
+    return feedparser.parse(content, response_headers=headers).entries
+
+def iterItems(stream):
+    """
+    Yield StreamEntries of the RSS items in a file-like stream as soon as
+    each item has been parsed; the document is never held in memory whole.
+    """
+    fields = {}
+    for event, elem in cElementTree.iterparse(stream):
+        tag = elem.tag.rpartition('}')[2]
+        if tag in ('link', 'title', 'pubDate', 'description'):
+            fields[tag] = (elem.text or '').strip()
+        elif tag == 'item':
+            yield StreamEntry(fields.get('link', ''), fields.get('title', ''),
+                    parseDate(fields.get('pubDate')), fields.get('description', ''))
+            fields = {}
+            elem.clear()
+
+
 class Feed:
     """
     Represents the feed.
 
     id: comic number id (in '[dddd] blahblah', dddd is the id)
+    delay: seconds between refreshes of this feed while it has new posts;
+    while it has none, refreshes back off by the factor backoff up to
+    maxDelay seconds (delay * maxBackoff by default), see nextDelay
+    updatesTopic: whether the comic threads of this feed drive the irc topic
+    threadStore: ThreadStore of this feed
+    streaming: read the feed with iterItems instead of feedparser; reading
+    stops at the first item not newer than anything seen (the feed is
+    assumed to list the most recent posts first)
+    parsePool: procpool.ProcessPool to parse the (non-streamed) feed in
     """
-    threadEntries = {}
     titleRe = r'\[(\d{4})\](.*)'
     postbyRe = r'Last reply by (.+) on'
-    linkRe = r'(\d+)'
+    # thread id in the path of a post link (/thread/1234/title...)
+    linkRe = r'/threads?/(\d+)'
     mostRecentId = None
     recentComicEntry = None
+    topic = None
     first = True
 
+    # scheduling state, maintained by Monitor
+    nextCheck = 0
+    pending = False
 
-    def __init__(self, url):
+    # conditional GET state: validators and the digest of the last body
+    etag = None
+    modified = None
+    digest = None
+    changed = False
+    timeout = 30.0
+
+    # adaptive polling: the current delay, and the least the server
+    # (Cache-Control, Retry-After, <ttl>) asked for on the last refresh
+    backoff = 1.5
+    maxBackoff = 8
+    interval = None
+    serverDelay = 0
+    ttl = 0
+
+
+    def __init__(self, url, delay, updatesTopic = True, threadStore = None, streaming = False,
+            parsePool = None, maxDelay = None, backoff = None):
         self.titlePat = re.compile(self.titleRe)
         self.postbyPat = re.compile(self.postbyRe)
         self.linkPat = re.compile(self.linkRe)
 
         self.url = url
-        log.debug("a feed created: %s", url)
+        self.setDelays(delay, maxDelay, backoff)
+        self.updatesTopic = updatesTopic
+        if threadStore is None:
+            threadStore = ThreadStore()
+        self.threadStore = threadStore
+        self.streaming = streaming
+        self.parsePool = parsePool
+        # keep-alive connection; requests negotiates gzip/deflate itself
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        log.debug("a feed created: %s (every %d sec)", url, delay)
+
+    def setDelays(self, delay, maxDelay = None, backoff = None):
+        self.delay = delay
+        self.maxDelay = maxDelay or delay * self.maxBackoff
+        if backoff is not None:
+            self.backoff = backoff
+        self.interval = delay
+
+    def nextDelay(self, failed = False):
+        """Seconds until the next refresh, after one: back to delay if it
+        found new posts, otherwise backoff times longer; at least what the
+        server asked for, at most maxDelay"""
+        if not failed and self.updatedThreads:
+            self.interval = self.delay
+        else:
+            self.interval = min(self.maxDelay, self.interval * self.backoff)
+        return min(self.maxDelay, max(self.interval, self.serverDelay))
 
     def refresh(self):
         log.debug("updating the feed")
         self.updatedThreads = []
-        self.parsedFeed = feedparser.parse(self.url)
-        self._readThreadEntries()
+        response = self._fetch()
+        self.changed = response is not None
+        if not self.changed:
+            # nothing new: the stored entries and topic are still valid
+            log.debug("feed %s unchanged", self.url)
+            return self.topic, self.updatedThreads
+        if self.streaming:
+            try:
+                entries = list(self._streamEntries(response))
+            finally:
+                response.close()
+        else:
+            # body is already decompressed; tell feedparser only the charset and base url
+            headers = {'content-type': response.headers.get('content-type', ''),
+                    'content-location': response.url}
+            if self.parsePool:
+                # refresh runs in a thread: wait there for a worker process
+                entries = self.parsePool.apply(parseEntries, response.content, headers)
+            else:
+                entries = parseEntries(response.content, headers)
+        self._readThreadEntries(entries)
         self._setCurrentTopic()
         self.first = False
-        log.debug("topic in the updated feed: %s", self.topic)
+        log.debug("topic in the updated feed %s: %s", self.url, self.topic)
         return self.topic, self.updatedThreads
 
         # consider introducing more proper twisted style threading here?
@@ -76,26 +316,81 @@ class Feed:
         # d.addCallback(handleParsedFeed)
         # -> handleParsedFeed takes the parsed feed, calls findComicEntries & setCurretTopic
 
-    def _readThreadEntries(self):
+    def _fetch(self):
+        """
+        Conditional GET of the feed document.
+
+        Returns the response, or None if the server answered 304 or the
+        body is byte-for-byte the same as last time. When streaming, the
+        body is left unread (and so not compared).
         """
-        Pours through the feed to find the threads with new posts
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.modified:
+            headers['If-Modified-Since'] = self.modified
+        if self.streaming:
+            # reading may stop before the end of the body: the connection
+            # must not go back to the session's pool with the rest unread
+            headers['Connection'] = 'close'
+        r = self.session.get(self.url, headers=headers, timeout=self.timeout, stream=self.streaming)
+        self.serverDelay = max(pollHint(r.headers), self.ttl)
+        if r.status_code == 304:
+            log.debug("feed %s not modified (304)", self.url)
+            r.close()
+            return None
+        r.raise_for_status()
+        self.etag = r.headers.get('etag', self.etag)
+        self.modified = r.headers.get('last-modified', self.modified)
+        if self.streaming:
+            return r
+
+        self.ttl = rssTtl(r.content)
+        self.serverDelay = max(self.serverDelay, self.ttl)
+        digest = hashlib.sha1(r.content).digest()
+        if digest == self.digest:
+            log.debug("feed %s body digest unchanged", self.url)
+            return None
+        self.digest = digest
+        return r
+
+    def _streamEntries(self, response):
+        """Entries of a streamed response, up to the first already seen post"""
+        response.raw.decode_content = True
+        read = 0
+        for e in iterItems(response.raw):
+            if not self.first and e.published_parsed and \
+                    calendar.timegm(e.published_parsed) <= self.threadStore.newest:
+                log.debug("reached posts seen already after %d new items", read)
+                return
+            read += 1
+            yield e
+
+    def _readThreadEntries(self, entries):
+        """
+        Pours through the feed entries to find the threads with new posts
         * with every thread, compare the new entry to the stored to see if there's new post
           -> add the thread to self.updatedThreads if affirmative
         * with comic entries, see if there's more recent topic title
         """
         log.debug("reading the feed...")
-        for e in self.parsedFeed.entries:
+        # without a (parseable) date a post can't be told new or old
+        dated = [e for e in entries if e.get('published_parsed')]
+        if len(dated) < len(entries):
+            log.debug("skipping %d undated items of %s", len(entries) - len(dated), self.url)
+        # oldest first, so that the store stays in order of last post
+        for e in sorted(dated, key=lambda e: e.get('published_parsed')):
             # has any thread new posts?
-            if e.link in self.threadEntries:
-                if e.published_parsed > self.threadEntries[e.link].published_parsed:
-                    self.threadEntries[e.link] = e
-                    self._addToUpdated(e)
-            else:
-                self.threadEntries[e.link] = e
-                # on first run threadEntries empty -> all existing look new
-                # after first run, all new entries are necros or new threads
-                if not self.first:
-                    self._addToUpdated(e)
+            threadId = self._threadId(e)
+            timestamp = calendar.timegm(e.published_parsed)
+            if self.threadStore.isNew(threadId, timestamp):
+                known = self.threadStore.get(threadId)
+                postby = self._postby(e)
+                self.threadStore.update(threadId, timestamp, postby)
+                # on first run the store is empty -> all existing look new
+                # after first run, all new threads are necros or new threads
+                if known or not self.first:
+                    self._addToUpdated(e, threadId, postby)
 
             # has the thread a comic thread style title?
             comicTitle = self._parseComicTitle(e)
@@ -109,12 +404,54 @@ class Feed:
                 else:
                     self.recentComicEntry = self._newer(e, self.recentComicEntry)
 
-    def _addToUpdated(self, e):
-        e.postby = self.postbyPat.match(e.summary).group(1)
-        e.recentlink = "http://gunnerkrigg.proboards.com/threads/recent/" + self.linkPat.search(e.link).group(1)
+        self.threadStore.evict(time.time())
+        log.debug("%d threads remembered in the feed %s", len(self.threadStore), self.url)
+
+    def snapshot(self):
+        """JSON-serializable state of the feed, see restore()"""
+        topic = None
+        if self.topic:
+            topic = [self.topic.comicId, self.topic.text]
+        return {'threads': self.threadStore.snapshot(),
+                'mostRecentId': self.mostRecentId,
+                'topic': topic}
+
+    def restore(self, snapshot):
+        """Warm start from a snapshot: the threads in it count as seen,
+        so the first refresh announces only what is new since"""
+        self.threadStore.restore(snapshot['threads'])
+        self.mostRecentId = snapshot['mostRecentId']
+        if snapshot['topic']:
+            self.topic = TopicStatus(*snapshot['topic'])
+        self.first = False
+        log.info("restored %d threads of the feed %s", len(self.threadStore), self.url)
+
+    def _threadId(self, e):
+        m = self.linkPat.search(urlparse.urlsplit(e.link).path)
+        if m:
+            return m.group(1)
+        return e.link
+
+    def _postby(self, e):
+        m = self.postbyPat.match(e.summary)
+        if m:
+            return m.group(1)
+        return "Someone"
+
+    def _addToUpdated(self, e, threadId, postby):
+        e.postby = postby
+        if threadId == e.link:
+            # not a link of a known board: nothing better to link to
+            e.recentlink = e.link
+        else:
+            e.recentlink = urlparse.urljoin(e.link, "/threads/recent/" + threadId)
         self.updatedThreads.append(e)
 
     def _setCurrentTopic(self):
+        if not self.recentComicEntry:
+            # not every board has comic threads
+            log.debug("no comic threads in the feed %s", self.url)
+            return
         parsed = self._parseComicTitle(self.recentComicEntry)
         self.topic = TopicStatus(parsed['id'], parsed['text'])
         log.debug("set current topic in the feed instance (%d)", parsed['id'])
@@ -132,9 +469,9 @@ class Feed:
         else:
             return m
 
-class Monitor:
+class Monitor(lifecycle.Module):
     """
-    Reads the RSS feed with a given frequency,
+    Reads the RSS feeds, each with its own (adaptive) frequency,
     commands the bot accordingly
     """
 
@@ -144,28 +481,66 @@ class Monitor:
 
     moduleName = 'rssfeed'
 
-    def __init__(self, rssConfig, bot, updatesTitle = True):
-        self.feed = Feed(rssConfig['url'])
-        self.delay = rssConfig['freq']
+    # how many feeds are refreshed at the same time
+    maxConcurrent = 4
+
+    def __init__(self, rssConfig, bot, updatesTitle = True, stateStore = None, parsePool = None):
+        if stateStore is None:
+            stateStore = statestore.StateStore()
+        self.stateStore = stateStore
+        self.parsePool = parsePool
+        self.feeds = [self.makeFeed(f, rssConfig) for f in self.parseFeedConfig(rssConfig)]
+        # the monitor wakes up every tick and refreshes the feeds that are due
+        self.delay = self.tickOf(rssConfig)
+        self.fanout = defer.DeferredSemaphore(rssConfig.get('maxConcurrent', self.maxConcurrent))
         self.isRunning = False
         self.bot = bot
         self.updatesTitle = updatesTitle
-        self.blockedForumUsers = {}
+        self.blockedForumUsers = self.stateStore.get(self.moduleName, 'blockedForumUsers', {})
 
         # precompile regex for topicparser
         self.topicPat = re.compile(self.topicRe)
 
-        # is this a good way to do this?
-        # consider another options:
-        # ...threading? ...proper delayed twisted deferrers? ...?
-        # now it acts like it were a gigantic 'one' method, timewise(?)
-        # now if rssCheck takes much time -> much blockin >.>
-
-        # we make rssCheck() a looping call
+        # rssCheck() is a looping call; the refreshes themselves run in
+        # threads, at most maxConcurrent at a time, and their results are
+        # merged into one announcement pass
         self.loopcall = task.LoopingCall(self.rssCheck)
         log.debug("Monitor instance created")
 
-        bot.registerModule(self.moduleName, self)
+    def parseFeedConfig(self, rssConfig):
+        """List of feed configs ({'url': ..., 'freq': ..., 'topic': ...})
+
+        The old single feed syntax (rss: {url: ..., freq: ...}) is still
+        understood."""
+        if 'feeds' in rssConfig:
+            return rssConfig['feeds']
+        return [{'url': rssConfig['url'], 'freq': rssConfig['freq']}]
+
+    def tickOf(self, rssConfig):
+        """Seconds between wake-ups: 'tick', or the gcd of the feed delays"""
+        if 'tick' in rssConfig:
+            return rssConfig['tick']
+        return reduce(fractions.gcd, [f.delay for f in self.feeds], 0) or rssConfig.get('freq', 60)
+
+    def makeFeed(self, feedConfig, rssConfig):
+        """A Feed with its own ThreadStore"""
+        storeConfig = rssConfig.get('threadStore', {})
+        store = ThreadStore(storeConfig.get('maxSize'), storeConfig.get('maxAge'))
+        parser = feedConfig.get('parser', rssConfig.get('parser', 'feedparser'))
+        feed = Feed(feedConfig['url'], feedConfig.get('freq', rssConfig.get('freq')),
+                feedConfig.get('topic', True), store, parser == 'stream', self.parsePool,
+                feedConfig.get('maxFreq', rssConfig.get('maxFreq')),
+                feedConfig.get('backoff', rssConfig.get('backoff')))
+        snapshot = self.stateStore.get(self.moduleName, 'feed:' + feed.url)
+        if snapshot:
+            feed.restore(snapshot)
+        return feed
+
+    def saveFeed(self, feed):
+        self.stateStore.put(self.moduleName, 'feed:' + feed.url, feed.snapshot())
+
+    def saveFilters(self):
+        self.stateStore.put(self.moduleName, 'blockedForumUsers', self.blockedForumUsers)
 
     # bot commands
     @command('rssfeed', ['refresh','update-feed'])
@@ -175,8 +550,8 @@ class Monitor:
         Slightly less descriptive 'update-feed' keyword provided for legacy purposes
         """
         log.info("bot received an update command. calling rssCheck()...")
-        self.bot.announce('Checking rss feed!')
-        self.rssCheck()
+        kwargs['bot'].announce('Checking rss feed!', channel=kwargs['channel'])
+        self.rssCheck(force=True)
 
     @command('rssfeed', ['update-topic'])
     def updatingTopicOn(self, cmdTokens, **kwargs):
@@ -198,14 +573,15 @@ class Monitor:
         """
         blockedUser = cmdTokens[1]
         reason = 'Not specified.'
-        if len(cmdTokens > 2):
+        if len(cmdTokens) > 2:
             reason = ' '.join(cmdTokens[2:])
         byWho = kwargs['user']
         log.info("blocked forum user: %s", blockedUser)
         log.info("block by %s", byWho)
         log.info("reason: %s", reason)
-        self.blockedForumUsers[blockedUser] = (byWho, reason);
-        self.bot.announce("Blocked!")
+        self.blockedForumUsers[blockedUser] = (byWho, reason)
+        self.saveFilters()
+        kwargs['bot'].announce("Blocked!", channel=kwargs['channel'])
 
     @command('rssfeed', ['remove-filter'])
     def removeForumUserFilter(self, cmdTokens, **kwargs):
@@ -215,9 +591,9 @@ class Monitor:
         log.info("Removing block")
         if self.isABlockedUser(blockedUser):
             self.clearBlockedUser(blockedUser)
-            self.bot.announce("Filter removed!")
+            kwargs['bot'].announce("Filter removed!", channel=kwargs['channel'])
         else:
-            self.bot.announce("No block in place!")
+            kwargs['bot'].announce("No block in place!", channel=kwargs['channel'])
 
     @command('rssfeed', ['tell-filter-status'])
     def tellForumUserFilterStatus(self, cmdTokens, **kwargs):
@@ -225,26 +601,74 @@ class Monitor:
         blockedUser = cmdTokens[1]
         if self.isABlockedUser(blockedUser):
             blockInfo = self.blockedUserInfo(blockedUser)
-            self.bot.announce("Posts filtered. Filter set by: "
-                    + str(blockInfo[0]) + ", reason: " + str(blockInfo[1]))
+            kwargs['bot'].announce("Posts filtered. Filter set by: "
+                    + str(blockInfo[0]) + ", reason: " + str(blockInfo[1]), channel=kwargs['channel'])
 
-    # internals
+    # lifecycle: following the feeds is resumed when a bot has joined,
+    # and paused while no bot is connected
     def start(self):
-        """Get the bot and start following the feed"""
-        log.info("starting following a feed...")
+        # loaded by a config reload: the bots have joined already
+        if self.bot.bots and not self.isRunning:
+            self.resume()
+
+    def detach(self, bot):
+        lifecycle.Module.detach(self, bot)
+        if not self.bot.bots and self.isRunning:
+            self.pause()
+
+    def reconfigure(self, rssConfig):
+        """Follow the feeds of a reloaded config; the feeds still in it
+        keep their state, and the tick changes without a restart"""
+        current = dict((f.url, f) for f in self.feeds)
+        feeds = []
+        for feedConfig in self.parseFeedConfig(rssConfig):
+            feed = current.get(feedConfig['url'])
+            if feed is None:
+                feed = self.makeFeed(feedConfig, rssConfig)
+            else:
+                feed.setDelays(feedConfig.get('freq', rssConfig.get('freq')),
+                        feedConfig.get('maxFreq', rssConfig.get('maxFreq')),
+                        feedConfig.get('backoff', rssConfig.get('backoff', Feed.backoff)))
+                feed.updatesTopic = feedConfig.get('topic', True)
+                feed.streaming = feedConfig.get('parser', rssConfig.get('parser', 'feedparser')) == 'stream'
+            feeds.append(feed)
+        log.info("following %d feeds (was %d)", len(feeds), len(self.feeds))
+        self.feeds = feeds
+        maxConcurrent = rssConfig.get('maxConcurrent', self.maxConcurrent)
+        if maxConcurrent != self.fanout.limit:
+            self.fanout = defer.DeferredSemaphore(maxConcurrent)
+        delay = self.tickOf(rssConfig)
+        if delay != self.delay:
+            log.info("feed monitor tick changed from %s to %s seconds", self.delay, delay)
+            self.delay = delay
+            if self.isRunning:
+                self.loopcall.stop()
+                self.loopcall.start(self.delay, now=False)
+        return True
+
+    def stop(self):
+        if self.isRunning:
+            self.pause()
+
+    # internals
+    def resume(self):
+        """Start following the feeds"""
+        log.info("starting following %d feeds...", len(self.feeds))
         self.isRunning = True
         self.loopcall.start(self.delay)
 
-    def stop(self):
-        """Stop following the feed"""
+    def pause(self):
+        """Stop following the feeds"""
         self.loopcall.stop()
-        log.info("stopped following a feed")
+        self.isRunning = False
+        log.info("stopped following the feeds")
 
 
     def clearBlockedUser(self, user):
         """Clea a blocked forum poster"""
         try:
             del self.blockedForumUsers[user]
+            self.saveFilters()
             log.info("removed user %s from blocklist", user)
         except KeyError:
             log.warning("can't remove user %s from blocklist", user)
@@ -262,10 +686,10 @@ class Monitor:
         """nuff said"""
         return user in self.blockedForumUsers
 
-    def _fetchIrcTopic(self):
-        """Get the current irc topic id status from the bot"""
-        log.debug("reading irc topic...")
-        self._rawirctopic = self.bot.getTopic()
+    def _fetchIrcTopic(self, bot, channelName):
+        """Get the current irc topic id status of a channel from its bot"""
+        log.debug("reading irc topic of %s...", channelName)
+        self._rawirctopic = bot.getTopic(channelName)
         log.debug("raw irc topic got form bot: %s", self._rawirctopic)
 
         # we might not be able to correctly parse raw irctopic if
@@ -306,45 +730,118 @@ class Monitor:
         text = m.group(3)
         return preamble, comicId, text
 
-    def rssCheck(self):
+    def rssCheck(self, force = False):
         """
-        Check if the rss feed has been updated with a fresh fora comic thread
-        if yes, call ircTopicUpdater
+        Refresh the feeds that are due (or all of them, if forced);
+        when every refresh has finished, handle the merged results
         """
-        log.debug("checking the rss feed...")
-        d_feed = threads.deferToThread(self.feed.refresh)
-
-        d_feed.addCallback(self._handleFeedUpdate)
-
-    def _handleFeedUpdate(self, (feedTopic, updatedThreads)):
-        """ Receives the current topic in the feed"""
-        log.debug("determining if topic should be updated")
-        ircTopic = self._fetchIrcTopic()
-        log.debug("sees current topic as %s" % ircTopic.fullTitle)
-        log.debug("sees feedTopic as %s" % feedTopic.fullTitle)
-        if feedTopic.isFresher(ircTopic):
-            self._ircTopicUpdate(feedTopic)
+        now = reactor.seconds()
+        due = [f for f in self.feeds if not f.pending and (force or f.nextCheck <= now)]
+        if not due:
+            return
+        log.debug("checking %d rss feeds...", len(due))
+        ds = []
+        for f in due:
+            f.pending = True
+            f.nextCheck = now + f.delay
+            d = self.fanout.run(self._refresh, f)
+            d.addErrback(self._handleFeedError, f)
+            d.addCallback(self._scheduleNext, f)
+            ds.append(d)
+        d_feeds = defer.gatherResults(ds)
+        d_feeds.addCallback(self._handleFeedUpdate)
+        d_feeds.addErrback(lambda e: log.error("handling feed updates failed: %s", e))
+        # a feed is not refreshed again before its results are handled
+        d_feeds.addBoth(self._feedsDone, due)
+        return d_feeds
+
+    def _refresh(self, feed):
+        """feed.refresh() in a thread, timed"""
+        started = time.time()
+
+        def timed(result):
+            metrics.registry.histogram('boxbot_feed_refresh_seconds', "time to refresh a feed",
+                    {'feed': feed.url}).observe(time.time() - started)
+            return result
+        d = threads.deferToThread(feed.refresh)
+        d.addBoth(timed)
+        return d
+
+    def _handleFeedError(self, failure, feed):
+        log.error("refreshing the feed %s failed: %s", feed.url, failure.getErrorMessage())
+        metrics.registry.counter('boxbot_feed_refresh_errors_total', "failed feed refreshes",
+                {'feed': feed.url}).inc()
+        return None
+
+    def _scheduleNext(self, result, feed):
+        """Set when the feed is due next, by how it went (result is None if
+        the refresh failed)"""
+        delay = feed.nextDelay(result is None)
+        feed.nextCheck = reactor.seconds() + delay
+        log.debug("next refresh of %s in %d sec", feed.url, delay)
+        metrics.registry.gauge('boxbot_feed_poll_seconds', "current delay between refreshes of a feed",
+                {'feed': feed.url}).set(delay)
+        return feed, result
+
+    def _feedsDone(self, result, feeds):
+        for f in feeds:
+            f.pending = False
+        return result
+
+    def _mergeResults(self, results):
+        """Combine refresh results of several feeds:
+        the freshest topic of the topic feeds and all updated threads"""
+        feedTopic = None
+        updatedThreads = []
+        seen = set()
+        for feed, (topic, updated) in results:
+            if feed.updatesTopic and topic:
+                if not feedTopic or topic.isFresher(feedTopic):
+                    feedTopic = topic
+            for t in updated:
+                if t.link not in seen:
+                    seen.add(t.link)
+                    updatedThreads.append(t)
+        updatedThreads.sort(key=lambda t: t.published_parsed)
+        return feedTopic, updatedThreads
+
+    def _handleFeedUpdate(self, results):
+        """ Receives the refresh results of the checked feeds"""
+        results = [(feed, r) for feed, r in results if r]
+        for feed, r in results:
+            if feed.changed:
+                self.saveFeed(feed)
+        feedTopic, updatedThreads = self._mergeResults(results)
+
+        if feedTopic:
+            log.debug("determining if topics should be updated")
+            for bot, chan in self.bot.subscribers(channel.TOPIC):
+                ircTopic = self._fetchIrcTopic(bot, chan.name)
+                log.debug("sees current topic of %s as %s" % (chan.name, ircTopic.fullTitle))
+                log.debug("sees feedTopic as %s" % feedTopic.fullTitle)
+                if feedTopic.isFresher(ircTopic):
+                    self._ircTopicUpdate(feedTopic, bot, chan.name)
 
         log.debug("announcing threads with new posts")
         for t in updatedThreads:
             if t.postby not in self.blockedForumUsers:
-                self.bot.announce(t.postby + " posted to '" + t.title + "' " + t.recentlink)
+                self.bot.announce(t.postby + " posted to '" + t.title + "' " + t.recentlink,
+                        priority=outbound.NOTICE, source=self.moduleName)
             else:
-                log.debug("filtering forum post by " + t.posty)
-                log.debug("filtered:" + self.blockedForumsUsers)
-
+                log.debug("filtering forum post by " + t.postby)
 
-    def _ircTopicUpdate(self, feedTopic):
+    def _ircTopicUpdate(self, feedTopic, bot, channelName):
         """
-        instruct the bot to set the irc topic into a fresh one
+        instruct the bot to set the irc topic of a channel into a fresh one
+        (the preamble is the one just read by _fetchIrcTopic)
         """
         log.info("monitor wants to update irc topic")
         t = self._preamble + feedTopic.fullTitle
         if self.updatesTitle:
             log.info("commanding bot to change the topic...")
-            self.bot.setTopic(t)
+            bot.setTopic(t, channelName)
         else:
             self._wantsToSet = t
             log.warning("asked to update topic but updatesTitle set false.")
             log.info("commanding bot to announce topic... %s", t)
-            self.bot.announceWant(t)
+            bot.announceWant(t, channelName)
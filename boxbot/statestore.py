@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+statestore module
+
+Bot state that survives restarts and reconnects (seen forum threads,
+topic, filters, counters...), kept in a SQLite file.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import sqlite3
+import json
+
+from twisted.internet import task
+
+
+class StateStore(object):
+    """
+    A key-value store of JSON-serializable values, grouped by namespace
+    (usually a module name).
+
+    Writes are collected in memory and written behind in one transaction
+    every flushInterval seconds (and when flush() is called). Without a
+    path, nothing is persisted: the state then only survives reconnects.
+    """
+
+    flushInterval = 30
+
+    def __init__(self, path = None, flushInterval = None):
+        if flushInterval is not None:
+            self.flushInterval = flushInterval
+        self.path = path
+        self.values = {}
+        self.dirty = set()
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS state ("
+                    "namespace TEXT, key TEXT, value TEXT, "
+                    "PRIMARY KEY (namespace, key))")
+            self._load()
+        self.loopcall = task.LoopingCall(self.flush)
+        log.debug("a state store created: %s", path)
+
+    def _load(self):
+        for namespace, key, value in self.db.execute("SELECT namespace, key, value FROM state"):
+            try:
+                self.values[(namespace, key)] = json.loads(value)
+            except ValueError as e:
+                log.warning("dropping unreadable state %s/%s: %s", namespace, key, e)
+        log.info("loaded %d state entries from %s", len(self.values), self.path)
+
+    def get(self, namespace, key, default = None):
+        return self.values.get((namespace, key), default)
+
+    def put(self, namespace, key, value):
+        """Store a value; it will be written on the next flush"""
+        self.values[(namespace, key)] = value
+        self.dirty.add((namespace, key))
+
+    def start(self):
+        """Start the periodic write-behind"""
+        if self.db and not self.loopcall.running:
+            self.loopcall.start(self.flushInterval, now=False)
+
+    def flush(self):
+        """Write all changed values in one transaction"""
+        if not self.db or not self.dirty:
+            self.dirty.clear()
+            return
+        rows = [(ns, key, json.dumps(self.values[(ns, key)])) for ns, key in self.dirty]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO state (namespace, key, value) "
+                    "VALUES (?, ?, ?)", rows)
+        log.debug("flushed %d state entries", len(rows))
+        self.dirty.clear()
+
+    def close(self):
+        """Flush and stop writing"""
+        if self.loopcall.running:
+            self.loopcall.stop()
+        self.flush()
+        if self.db:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+titlecache module
+
+Remembers url titles so that links pasted again are answered without
+fetching them again.
+"""
+
+import logging
+log = logging.getLogger(__name__)
+
+import collections
+import sqlite3
+import time
+import urlparse
+
+from twisted.internet import task
+
+defaultPorts = {'http': ':80', 'https': ':443'}
+
+def normalizeUrl(url):
+    """
+    Cache key of an url: scheme and host lowercased, default port and
+    fragment dropped, empty path made '/'
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url.strip())
+    scheme = scheme.lower() or 'http'
+    netloc = netloc.lower()
+    port = defaultPorts.get(scheme)
+    if port and netloc.endswith(port):
+        netloc = netloc[:-len(port)]
+    return urlparse.urlunsplit((scheme, netloc.rstrip('.'), path or '/', query, ''))
+
+
+class CacheEntry(object):
+    """A cached title; title is None for a (negative) entry of a failed fetch"""
+
+    __slots__ = ('title', 'finalUrl', 'expires')
+
+    def __init__(self, title, finalUrl, expires):
+        self.title = title
+        self.finalUrl = finalUrl
+        self.expires = expires
+
+
+class DiskTier(object):
+    """
+    Cache entries in a SQLite file, so that they survive restarts.
+
+    Like the state store, entries are written behind: put() only collects
+    them, and they're written in one transaction every flushInterval
+    seconds (once started) and when closing.
+    """
+
+    flushInterval = 30
+
+    def __init__(self, path, flushInterval = None):
+        if flushInterval is not None:
+            self.flushInterval = flushInterval
+        self.pending = {}
+        self.loopcall = task.LoopingCall(self.flush)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS titles ("
+                "url TEXT PRIMARY KEY, title TEXT, finalUrl TEXT, expires REAL)")
+        with self.db:
+            self.db.execute("DELETE FROM titles WHERE expires < ?", (time.time(),))
+
+    def get(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        row = self.db.execute("SELECT title, finalUrl, expires FROM titles WHERE url = ?",
+                (key,)).fetchone()
+        if row:
+            return CacheEntry(*row)
+        return None
+
+    def put(self, key, entry):
+        """Store an entry; it will be written on the next flush"""
+        self.pending[key] = entry
+
+    def start(self):
+        if not self.loopcall.running:
+            self.loopcall.start(self.flushInterval, now=False)
+
+    def flush(self):
+        """Write the pending entries in one transaction"""
+        if not self.pending:
+            return
+        rows = [(key, e.title, e.finalUrl, e.expires) for key, e in self.pending.iteritems()]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO titles (url, title, finalUrl, expires) "
+                    "VALUES (?, ?, ?, ?)", rows)
+        log.debug("flushed %d cached titles", len(rows))
+        self.pending.clear()
+
+    def close(self):
+        if self.loopcall.running:
+            self.loopcall.stop()
+        self.flush()
+        self.db.close()
+
+
+class TitleCache(object):
+    """
+    Two-tier cache of url titles, keyed by normalized url.
+
+    An in-memory LRU of at most maxEntries entries sits in front of an
+    optional DiskTier (if a path is given), written behind every
+    flushInterval seconds once started. Titles expire after ttl
+    seconds, failures (negative entries) after negativeTtl seconds.
+    A title is stored under the final url after redirects, too.
+    """
+
+    maxEntries = 1000
+    ttl = 6 * 60 * 60
+    negativeTtl = 5 * 60
+
+    def __init__(self, maxEntries = None, ttl = None, negativeTtl = None, path = None,
+            flushInterval = None):
+        if maxEntries is not None:
+            self.maxEntries = maxEntries
+        if ttl is not None:
+            self.ttl = ttl
+        if negativeTtl is not None:
+            self.negativeTtl = negativeTtl
+        self.memory = collections.OrderedDict()
+        self.disk = None
+        if path:
+            self.disk = DiskTier(path, flushInterval)
+        log.debug("a title cache created (%d entries, disk: %s)", self.maxEntries, path)
+
+    def get(self, url):
+        """CacheEntry of the url or None if there's no fresh one"""
+        key = normalizeUrl(url)
+        now = time.time()
+        entry = self.memory.pop(key, None)
+        if entry is None and self.disk:
+            entry = self.disk.get(key)
+        if entry is None or entry.expires < now:
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, url, title, finalUrl = None):
+        """Cache the title of url (and of finalUrl)"""
+        entry = CacheEntry(title, finalUrl or url, time.time() + self.ttl)
+        keys = set([normalizeUrl(url), normalizeUrl(entry.finalUrl)])
+        for key in keys:
+            self._remember(key, entry)
+            if self.disk:
+                self.disk.put(key, entry)
+
+    def putFailure(self, url):
+        """Remember for a short while that url couldn't be fetched"""
+        entry = CacheEntry(None, url, time.time() + self.negativeTtl)
+        self._remember(normalizeUrl(url), entry)
+
+    def _remember(self, key, entry):
+        self.memory.pop(key, None)
+        self.memory[key] = entry
+        while len(self.memory) > self.maxEntries:
+            self.memory.popitem(last=False)
+
+    def start(self):
+        """Start the periodic writes to disk"""
+        if self.disk:
+            self.disk.start()
+
+    def close(self):
+        if self.disk:
+            self.disk.close()
+            self.disk = None
@@ -16,35 +16,263 @@ from tweepy import OAuthHandler
 from tweepy import Stream
 import tweepy
 from twisted.words.protocols.irc import attributes
+from twisted.internet import reactor, task, threads
 
 import json
+import time
+import re
+import threading
+import collections
 
-class IRCListener(StreamListener):
+import outbound
+import statestore
+import metrics
+import lifecycle
 
-    def __init__(self, config, bot):
+
+class TweetQueue(object):
+    """
+    Bounded hand-over of tweets from the stream thread to the reactor.
+
+    Tweets are delivered in batches, at most one batch every interval
+    seconds, so at most maxSize tweets per interval get through. Tweets
+    arriving to a full queue are dropped; with the 'digest' overflow
+    policy the number dropped is delivered after the batch, with 'drop'
+    it is only logged.
+    """
+
+    maxSize = 20
+    interval = 2.0
+    overflow = 'digest'
+
+    def __init__(self, deliver, deliverDropped, maxSize = None, interval = None, overflow = None,
+            clock = reactor):
+        """deliver(tweet) and deliverDropped(count) are called in the reactor"""
+        if maxSize is not None:
+            self.maxSize = maxSize
+        if interval is not None:
+            self.interval = interval
+        if overflow is not None:
+            self.overflow = overflow
+        self.deliver = deliver
+        self.deliverDropped = deliverDropped
+        self.clock = clock
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.dropped = 0
+        self.lastDrain = 0
+        self.droppedCount = metrics.registry.counter('boxbot_tweets_dropped_total',
+                "tweets dropped on a full queue")
+        metrics.registry.gauge('boxbot_tweets_queued', "tweets waiting for the reactor",
+                fn=lambda: len(self.items))
+
+    def put(self, tweet):
+        """Queue a tweet; called in the stream thread. False if it was dropped"""
+        with self.lock:
+            if len(self.items) >= self.maxSize:
+                self.dropped += 1
+                self.droppedCount.inc()
+                return False
+            self.items.append(tweet)
+            if self.scheduled:
+                return True
+            self.scheduled = True
+        reactor.callFromThread(self._schedule)
+        return True
+
+    def _schedule(self):
+        delay = max(0, self.lastDrain + self.interval - self.clock.seconds())
+        self.clock.callLater(delay, self.drain)
+
+    def drain(self):
+        self.lastDrain = self.clock.seconds()
+        with self.lock:
+            tweets = list(self.items)
+            self.items.clear()
+            dropped, self.dropped = self.dropped, 0
+            self.scheduled = False
+        for tweet in tweets:
+            self.deliver(tweet)
+        if dropped:
+            log.warning("tweet queue full, %d tweets dropped", dropped)
+            if self.overflow == 'digest':
+                self.deliverDropped(dropped)
+
+
+class IngestStream(Stream):
+    """A Stream that can connect to another host, e.g. a local stand-in"""
+
+    def __init__(self, auth, listener, streamHost = None, **options):
+        Stream.__init__(self, auth, listener, **options)
+        self.streamHost = streamHost
+
+    def _start(self, async):
+        # filter() sets the twitter host just before starting
+        if self.streamHost:
+            self.host = self.streamHost
+        Stream._start(self, async)
+
+class IRCListener(StreamListener, lifecycle.Module):
+    """
+    Relays the tweets of the followed users.
+
+    Screen names are resolved to user ids with batched users/lookup
+    requests, in a thread; the ids are kept in the state store and trusted
+    for userIdTtl seconds, so that (re)starting doesn't wait for twitter.
+    They are re-resolved in the background when they get old.
+
+    In the stream thread, messages not mentioning a followed id are
+    skipped before decoding; tweets of the followed users go to the
+    reactor through a TweetQueue.
+    """
+
+    moduleName = 'twitter'
+
+    # how long resolved user ids are trusted, seconds
+    userIdTtl = 24 * 60 * 60
+    # screen names per users/lookup request (the api maximum)
+    lookupBatch = 100
+
+    def __init__(self, config, bot, stateStore = None):
         self.bot = bot
 
         self.auth = OAuthHandler(config["auth"]["consumer_key"], config["auth"]["consumer_secret"])
         self.auth.set_access_token(config["auth"]["access_token"], config["auth"]["access_token_secret"])
 
-        api = tweepy.API(self.auth)
+        self.authConfig = config["auth"]
+        self.api = tweepy.API(self.auth)
+        self.stream = None
+        self.users = []
+        self.userIds = frozenset()
+        self.candidatePat = None
+        streamConfig = config.get("stream", {})
+        self.streamOptions = {'streamHost': streamConfig.get("host"),
+                'verify': streamConfig.get("verify", True)}
+        queueConfig = config.get("queue", {})
+        self.queue = TweetQueue(self.announceTweet, self.announceDropped, queueConfig.get("maxSize"),
+                queueConfig.get("interval"), queueConfig.get("overflow"))
+        self.skipped = metrics.registry.counter('boxbot_tweets_skipped_total',
+                "stream messages skipped without decoding")
+        self.follow = config["follow"]
+        if config.get("userIdTtl") is not None:
+            self.userIdTtl = config["userIdTtl"]
+        if stateStore is None:
+            stateStore = statestore.StateStore()
+        self.stateStore = stateStore
+        self.refresher = task.LoopingCall(self.refreshUsers)
+        self.firstRefresh = None
 
-        stream = Stream(self.auth, self)
+        log.debug("a twitter.IRCListener instance created")
 
-        self.users = [str(api.get_user(u).id) for u in config["follow"]]
-        stream.filter(follow=self.users, async=True)
+    def start(self):
+        """Follow the cached ids right away, if there are any; resolve
+        again now if the cache is old or the follow list has new names"""
+        cached = self.stateStore.get(self.moduleName, 'userIds', {})
+        ids = cached.get('ids', {})
+        due = 0
+        if ids:
+            self.followIds(ids)
+            if set(u.lower() for u in self.follow) <= set(cached.get('names', [])):
+                due = max(0, cached.get('resolved', 0) + self.userIdTtl - time.time())
+        self.firstRefresh = reactor.callLater(due, self.refresher.start, self.userIdTtl)
 
-        log.debug("a twitter.IRCListener instance created")
+    def stop(self):
+        """Stop resolving and close the stream"""
+        if self.firstRefresh and self.firstRefresh.active():
+            self.firstRefresh.cancel()
+        if self.refresher.running:
+            self.refresher.stop()
+        if self.stream:
+            log.info("closing the twitter stream")
+            self.stream.disconnect()
+            self.stream = None
+
+    def reconfigure(self, config):
+        """Take a changed follow list, id ttl and queue limits in place; new
+        credentials or stream settings need a new listener"""
+        streamConfig = config.get("stream", {})
+        streamOptions = {'streamHost': streamConfig.get("host"),
+                'verify': streamConfig.get("verify", True)}
+        if config["auth"] != self.authConfig or streamOptions != self.streamOptions:
+            return False
+        queueConfig = config.get("queue", {})
+        self.queue.maxSize = queueConfig.get("maxSize", TweetQueue.maxSize)
+        self.queue.interval = queueConfig.get("interval", TweetQueue.interval)
+        self.queue.overflow = queueConfig.get("overflow", TweetQueue.overflow)
+        userIdTtl = config.get("userIdTtl", IRCListener.userIdTtl)
+        if userIdTtl != self.userIdTtl:
+            self.userIdTtl = userIdTtl
+            if self.refresher.running:
+                self.refresher.stop()
+                self.refresher.start(self.userIdTtl, now=False)
+        if config["follow"] != self.follow:
+            log.info("twitter follow list changed, resolving users again")
+            self.follow = config["follow"]
+            self.refreshUsers()
+        return True
+
+    def refreshUsers(self):
+        """Resolve the followed screen names again, in a thread"""
+        log.debug("resolving %d twitter users...", len(self.follow))
+        d = threads.deferToThread(self.lookupUsers, self.follow)
+        d.addCallback(self._usersResolved)
+        d.addErrback(lambda e: log.error("resolving twitter users failed: %s", e.getErrorMessage()))
+        return d
+
+    def lookupUsers(self, names):
+        """{lowercased screen name: user id} of names; blocking"""
+        ids = {}
+        for i in range(0, len(names), self.lookupBatch):
+            for user in self.api.lookup_users(screen_names=names[i:i + self.lookupBatch]):
+                ids[user.screen_name.lower()] = user.id_str
+        return ids
+
+    def _usersResolved(self, ids):
+        missing = [u for u in self.follow if u.lower() not in ids]
+        if missing:
+            log.warning("twitter users not found: %s", ", ".join(missing))
+        self.stateStore.put(self.moduleName, 'userIds', {'resolved': time.time(), 'ids': ids,
+            'names': [u.lower() for u in self.follow]})
+        self.followIds(ids)
+
+    def followIds(self, ids):
+        """(Re)start the stream, if the ids to follow changed"""
+        users = sorted(set(ids[u.lower()] for u in self.follow if u.lower() in ids))
+        if self.stream and users == self.users:
+            return
+        if self.stream:
+            log.info("followed twitter users changed, restarting the stream")
+            self.stream.disconnect()
+        self.users = users
+        self.userIds = frozenset(users)
+        # '"id_str":"<id>"' of a followed user, as in the tweet's user object
+        self.candidatePat = None
+        if users:
+            self.candidatePat = re.compile(r'"id_str"\s*:\s*"(?:%s)"' % '|'.join(users))
+        self.stream = IngestStream(self.auth, self, **self.streamOptions)
+        self.stream.filter(follow=self.users, async=True)
 
     def on_data(self, data):
+        # in the stream thread
+        pat = self.candidatePat
+        if not pat or not pat.search(data):
+            self.skipped.inc()
+            return True
         parsed = json.loads(data)
-        if "text" in parsed and parsed["user"]["id_str"] in self.users:
-            # TODO: use Twisted color formatting
-            ourtweeter = parsed["user"]["name"]
-            ourtweet = parsed["text"]
-            statusLinkPart = " - https://twitter.com/" + parsed["user"]["screen_name"] + "/status/" + parsed["id_str"]
-            self.bot.announce(ourtweeter, " tweeted ", ourtweet, statusLinkPart, specialColors=(None, None, attributes.fg.blue, None))
+        if "text" in parsed and parsed["user"]["id_str"] in self.userIds:
+            statusLink = " - https://twitter.com/" + parsed["user"]["screen_name"] + "/status/" + parsed["id_str"]
+            self.queue.put((parsed["user"]["name"], parsed["text"], statusLink))
         return True
 
+    def announceTweet(self, (tweeter, tweet, statusLink)):
+        self.bot.announce(tweeter, " tweeted ", tweet, statusLink,
+                specialColors=(None, None, attributes.fg.blue, None),
+                priority=outbound.NOTICE, source='twitter')
+
+    def announceDropped(self, count):
+        self.bot.announce(u"(%d more tweets skipped)" % count,
+                priority=outbound.NOTICE, source='twitter')
+
     def on_error(self, status):
         log.debug("Twitter error: " + str(status))
@@ -11,29 +11,45 @@ log = logging.getLogger(__name__)
 
 import datetime
 
-from twisted.internet import task, reactor, threads
+from twisted.internet import reactor
 
 # custom
+from command import command
 import clock
+import lifecycle
+import outbound
 
 
 
-class Notifier(object):
+class Notifier(lifecycle.Module):
 
-    """Docstring for Notifier. """
+    """
+    Announces comic updates when they are due and tells the time until
+    the next one.
+
+    The weekly schedules of all comics are one clock.Timeline; a single
+    timer is armed for its next update, and re-armed when it fires.
+    """
+
+    moduleName = 'updatenotifier'
 
     bot = None
     comics = None   # a dictionary of update schedules
     default_comic = None
 
-    def __init__(self, notifyConfig, bot):
-        """@todo: to be defined1. """
+    def __init__(self, notifyConfig, bot, reactorClock = reactor):
         self.bot = bot
-        self.comics, self.default_comic = self.parseConfig(notifyConfig)
+        self.reactorClock = reactorClock
+        self.timer = None
+        self.configure(notifyConfig)
         log.debug("a notifier instance created")
 
+    def configure(self, notifyConfig):
+        self.comics, self.default_comic = self.parseConfig(notifyConfig)
+        self.timeline = clock.Timeline(self.comics)
+
     def parseSchedule(self, schedule):
-        return {k: datetime.time(int(schedule[k][0]), int(schedule[k][1]))
+        return {int(k): datetime.time(int(schedule[k][0]), int(schedule[k][1]))
                 for k in schedule}
 
     def parseConfig(self, notifyConfig):
@@ -41,39 +57,78 @@ class Notifier(object):
                 for comic in notifyConfig['comics']}
         return comics, notifyConfig['defaultComic']
 
-    def parseMsg(self, msg):
-        log.debug("parsing msg %s" % msg)
-        for k in self.comics.keys():
-            idents = k.split()
-            log.debug("idents %s" %idents)
-            for i in idents:
-                # "next update" is the cmdstring to call Notifier
-                # get rid of this hardcoded value someday
-                if i in msg[len(self.bot.nickname + "next update ") + 1:]:
-                    return k
-        log.debug("returning empty string")
-        return ""
-
-    def askedNextUpdateWith(self, msg):
-        self.handleCommand(self.parseMsg(msg))
-
-    def handleCommandError(self, e):
-        e.trap(Exception)
-        log.error("next update command parsing error: %s" % e)
-
-    def handleCommand(self, cmd):
-        log.debug("handling cmd: %s" % cmd)
-        if not cmd:
-            log.info("comic name wasn't specified, assuming the default...")
-            comic = self.default_comic
-        elif cmd not in self.comics:
-            log.info("the parsed comic name not recognized...")
-            self.bot.announce("Aww, I don't recognize that comic!")
-            return None
-        else:
-            log.debug("comic_name successfully retrieved from msg")
-            comic = cmd
-
+    # lifecycle
+    def start(self):
+        self.arm()
+
+    def stop(self):
+        if self.timer and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+
+    def reconfigure(self, notifyConfig):
+        self.configure(notifyConfig)
+        if self.timer:
+            self.stop()
+            self.arm()
+        return True
+
+    # bot commands
+    @command('updatenotifier', ['next-update'])
+    def nextUpdate(self, cmdTokens, **kwargs):
+        """Tells the time until the next update: next-update [comic]"""
+        comic = self.findComic(' '.join(cmdTokens[1:]))
+        if comic is None:
+            kwargs['bot'].announce("Aww, I don't recognize that comic!", channel=kwargs['channel'])
+            return
         log.info("Announcing time until the next update")
-        self.bot.announce("Time until the next update in the comic " + cmd)
-        self.bot.announce(clock.timeUntilNextUpdate(self.comics[comic]))
+        until = self.timeline.timeUntil(self.now(), comic)
+        if until is None:
+            kwargs['bot'].announce("No updates scheduled for " + comic + ".", channel=kwargs['channel'])
+            return
+        kwargs['bot'].announce("Time until the next update in the comic " + comic + ": "
+                + clock.prettify(until), channel=kwargs['channel'])
+
+    def findComic(self, name):
+        """The comic of a name (or a word of it), the default for no name,
+        or None"""
+        if not name:
+            return self.default_comic
+        for comic in self.comics:
+            if name.lower() == comic.lower():
+                return comic
+        for comic in self.comics:
+            if name.lower() in comic.lower().split():
+                return comic
+        return None
+
+    # internals
+    def now(self):
+        return datetime.datetime.utcfromtimestamp(self.reactorClock.seconds())
+
+    def arm(self, after = None):
+        """Arm the timer for the next update after the week offset (after
+        now by default)"""
+        now = clock.weekOffset(self.now())
+        if after is None:
+            after = now
+        else:
+            # the update that fired, and now, are a moment apart but
+            # maybe on different sides of the week boundary
+            now = after + (now - after + clock.WEEK / 2) % clock.WEEK - clock.WEEK / 2
+        upcoming = self.timeline.nextAfter(after)
+        if upcoming is None:
+            log.info("no comic updates scheduled")
+            self.timer = None
+            return
+        offset, comics = upcoming
+        delay = max(0, offset - now)
+        log.debug("next comic update (%s) in %d seconds", ", ".join(comics), delay)
+        self.timer = self.reactorClock.callLater(delay, self.updateDue, offset % clock.WEEK, comics)
+
+    def updateDue(self, offset, comics):
+        for comic in comics:
+            log.info("comic update due: %s", comic)
+            self.bot.announce(comic + " should have updated!",
+                    priority=outbound.NOTICE, source='updatenotifier')
+        self.arm(offset)
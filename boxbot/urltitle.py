@@ -2,20 +2,38 @@
 
 """
 urltitle module
+
+requests and twisted.web are imported on first use, by the engine in use.
 """
 
 import logging
 log = logging.getLogger(__name__)
 
-from twisted.internet import reactor, defer
-from  bs4 import BeautifulSoup
-import requests
+from twisted.internet import reactor, defer, protocol, threads
+from HTMLParser import HTMLParser, HTMLParseError
+import codecs
+import urlparse
 import re
 
-urlRe = r'http(s)?://'
-urlPat = re.compile(urlRe)
-wwwRe = r'www([.].+){2}'
-wwwPat = re.compile(wwwRe)
+# http(s) urls and www.-prefixed host names, in one pass
+urlsRe = r'https?://\S+|\bwww[.][^\s.]+[.]\S+'
+urlsPat = re.compile(urlsRe)
+
+# stop reading a page after this many bytes if there's no </title> yet
+defaultMaxBytes = 64 * 1024
+chunkSize = 4 * 1024
+timeout = 5.0
+userAgent = 'boxbot'
+
+# shared keep-alive connections, see getSession()
+session = None
+
+def getSession():
+    global session
+    if session is None:
+        import requests
+        session = requests.Session()
+    return session
 
 def sizeOf(contLength):
     num = int(contLength)
@@ -24,42 +42,346 @@ def sizeOf(contLength):
             return "%.1f %s" % (num, d)
         num /= 1024.0
 
+def parseUrls(msg, limit = None):
+    """
+    All urls in msg in order of appearance, without duplicates
+    (at most limit of them).
+    """
+    return collectUrls((m.group(0) for m in urlsPat.finditer(msg)), limit)
+
+def collectUrls(matches, limit = None):
+    """Urls from urlsPat matches: www. ones made http://, duplicates dropped"""
+    urls = []
+    seen = set()
+    for url in matches:
+        if not url.startswith('http'):
+            url = "http://" + url
+        if url not in seen:
+            seen.add(url)
+            urls.append(url)
+            if len(urls) == limit:
+                break
+    return urls
+
 def parseUrl(msg):
     """
-    See if maybeUrl is an url.
+    See if maybeUrl is an url: the first url in msg, or "".
+    """
+    urls = parseUrls(msg, 1)
+    if urls:
+        return urls[0]
+    return ""
+
+class TitleParser(HTMLParser):
+    """Incremental HTML parser that picks up the text of the first <title>"""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.inTitle = False
+        self.done = False
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and not self.done:
+            self.inTitle = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.inTitle:
+            self.inTitle = False
+            self.done = True
+
+    def handle_data(self, data):
+        if self.inTitle:
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        self.handle_data(self.unescape('&%s;' % name))
+
+    def handle_charref(self, name):
+        self.handle_data(self.unescape('&#%s;' % name))
+
+    def title(self):
+        """The title with whitespace collapsed, or None"""
+        title = ' '.join(''.join(self.parts).split())
+        return title or None
+
+class TitleReader(object):
+    """
+    Feeds chunks of a html document to a TitleParser until the title has
+    been read or maxBytes have been consumed.
+    """
+
+    def __init__(self, encoding, maxBytes):
+        self.parser = TitleParser()
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.maxBytes = maxBytes
+        self.read = 0
+        self.done = False
+
+    def feed(self, chunk):
+        """Returns True when no more input is needed"""
+        self.read += len(chunk)
+        try:
+            self.parser.feed(self.decoder.decode(chunk))
+        except HTMLParseError as e:
+            log.debug("giving up parsing html after %d bytes: %s", self.read, e)
+            self.done = True
+        self.done = self.done or self.parser.done or self.read >= self.maxBytes
+        return self.done
+
+    def title(self):
+        log.debug("read %d bytes for the title", self.read)
+        return self.parser.title()
+
+    result = title
+
+class TitleBuffer(object):
+    """
+    Like TitleReader, but only collects the bytes up to </title> (or
+    maxBytes) for parsing elsewhere, e.g. in a worker process.
     """
-    url = urlPat.search(msg)
-
-    if not url:
-        www = wwwPat.search(msg)
-        if not www:
-            return ""
-        msg = "http://" + msg[www.start():]
-        urlIndex = 0
-    else:
-        urlIndex = url.start()
 
-    msgParts = msg[urlIndex:].split()
-    return msgParts[0]
+    endTag = '</title'
 
-def fetchTitle(url):
+    def __init__(self, maxBytes):
+        self.chunks = []
+        self.maxBytes = maxBytes
+        self.read = 0
+        self.done = False
+        self.tail = ''
+
+    def feed(self, chunk):
+        """Returns True when no more input is needed"""
+        self.read += len(chunk)
+        self.chunks.append(chunk)
+        # the end tag may be split between chunks
+        window = (self.tail + chunk).lower()
+        self.tail = window[-len(self.endTag):]
+        self.done = self.endTag in window or self.read >= self.maxBytes
+        return self.done
+
+    def result(self):
+        return ''.join(self.chunks)
+
+def readTitle(chunks, encoding, maxBytes):
+    """Title of a html document in chunks, or None"""
+    reader = TitleReader(encoding, maxBytes)
+    for chunk in chunks:
+        if reader.feed(chunk):
+            break
+    return reader.title()
+
+def titleText(title, maxBytes):
+    if not title:
+        raise ValueError("no title in the first %d bytes" % maxBytes)
+    return "Title: " + title
+
+def charsetOf(contentType):
+    """Charset from a content-type header value; utf-8 if there's none"""
+    for param in contentType.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            try:
+                return codecs.lookup(value.strip().strip('"\'')).name
+            except LookupError:
+                break
+    return 'utf-8'
+
+def pageEncoding(response):
+    return charsetOf(response.headers.get('content-type', ''))
+
+def fetchTitle(url, maxBytes = None):
     """
     fetches the title of the document behind the url
     because request library functions are blocking, this is for the sake of
     simplity implemented as a blocking function too;
     to be in run in a thread.
+
+    Only one streaming GET is made; reading stops at </title> or after
+    maxBytes bytes, whichever comes first.
     """
+    return fetchTitleAndUrl(url, maxBytes)[0]
+
+def fetchTitleAndUrl(url, maxBytes = None):
+    """As fetchTitle, but returns (title, final url after redirects)"""
+    if maxBytes is None:
+        maxBytes = defaultMaxBytes
     try:
-        r = requests.head(url, timeout = 5.0, allow_redirects = True)
-        if 'text/html' in r.headers['content-type']:
-            rd = requests.get(url)
-            soup = BeautifulSoup(rd.text)
-            return "Title: " + soup.title.string.strip()
-        elif 'content-type' and 'content-length' in r.headers:
-            return "content-type: "+ r.headers['content-type'] + ", size " + sizeOf(r.headers['content-length'])
-    	else:
-	    return "aww, what a strange link."
+        r = getSession().get(url, timeout = timeout, stream = True, allow_redirects = True)
+        try:
+            return describe(r, maxBytes), r.url
+        finally:
+            r.close()
     except Exception as e:
         # thrown an exception
         log.error("fetchTitle produced exception: %s", e)
         raise
+
+def describe(r, maxBytes):
+    """Title text of a streaming response"""
+    contentType = r.headers.get('content-type', '')
+    if 'text/html' in contentType:
+        return titleText(readTitle(r.iter_content(chunkSize), pageEncoding(r), maxBytes), maxBytes)
+    elif contentType and 'content-length' in r.headers:
+        return "content-type: "+ contentType + ", size " + sizeOf(r.headers['content-length'])
+    else:
+        return "aww, what a strange link."
+
+
+class ThreadedTitleFetcher(object):
+    """Title fetching with blocking requests in the reactor threadpool"""
+
+    def __init__(self, maxBytes = None):
+        self.maxBytes = maxBytes
+
+    def fetch(self, url):
+        """Deferred firing with (title, final url)"""
+        return threads.deferToThread(fetchTitleAndUrl, url, self.maxBytes)
+
+    def close(self):
+        pass
+
+
+class TitleProtocol(protocol.Protocol):
+    """Consumes a response body with a TitleReader (or TitleBuffer); fires
+    finished with its result once the reader is done or the body ends"""
+
+    cancelled = False
+
+    def __init__(self, finished, reader):
+        self.finished = finished
+        self.reader = reader
+
+    def dataReceived(self, data):
+        if self.reader.done:
+            return
+        if self.reader.feed(data):
+            self.stop()
+
+    def connectionLost(self, reason):
+        self._done()
+
+    def stop(self):
+        """Stop reading the body, the reader is done"""
+        self._done()
+        self.transport.stopProducing()
+
+    def cancel(self):
+        """Stop reading the body without a result: finished errbacks with
+        CancelledError instead"""
+        self.cancelled = True
+        self.transport.stopProducing()
+
+    def _done(self):
+        if not self.cancelled and not self.finished.called:
+            self.finished.callback(self.reader.result())
+
+
+class DiscardBody(protocol.Protocol):
+    """Closes the connection instead of reading the body"""
+
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+class TitleFetcher(object):
+    """
+    Non-blocking title fetching on a twisted Agent.
+
+    Connections are kept alive in an HTTPConnectionPool, redirects are
+    followed and gzip is accepted. At most maxConcurrent requests are made
+    at once, and at most perHost to the same host; a fetch taking longer
+    than timeout seconds is cancelled. No threads are used; with a
+    parsePool (procpool.ProcessPool) the html is parsed in a worker
+    process, the reactor only looks for the end of the title.
+    """
+
+    maxConcurrent = 8
+    perHost = 2
+    timeout = 10.0
+
+    def __init__(self, maxConcurrent = None, perHost = None, timeout = None, maxBytes = None,
+            parsePool = None):
+        if maxConcurrent is not None:
+            self.maxConcurrent = maxConcurrent
+        if perHost is not None:
+            self.perHost = perHost
+        if timeout is not None:
+            self.timeout = timeout
+        self.maxBytes = maxBytes or defaultMaxBytes
+        self.parsePool = parsePool
+
+        from twisted.web import client
+        self.pool = client.HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = self.perHost
+        self.agent = client.ContentDecoderAgent(
+                client.BrowserLikeRedirectAgent(
+                    client.Agent(reactor, connectTimeout=self.timeout, pool=self.pool)),
+                [('gzip', client.GzipDecoder)])
+        self.slots = defer.DeferredSemaphore(self.maxConcurrent)
+        self.hostSlots = {}
+        log.debug("a title fetcher created (%d at once, %d per host)",
+                self.maxConcurrent, self.perHost)
+
+    def fetch(self, url):
+        """Deferred firing with (title, final url)"""
+        host = urlparse.urlsplit(url).netloc.lower()
+        if host not in self.hostSlots:
+            self.hostSlots[host] = defer.DeferredSemaphore(self.perHost)
+        d = self.hostSlots[host].run(self.slots.run, self._fetch, url)
+        d.addBoth(self._releaseHost, host)
+        return d
+
+    def close(self):
+        """Close the kept-alive connections"""
+        return self.pool.closeCachedConnections()
+
+    def _releaseHost(self, result, host):
+        hostSlot = self.hostSlots.get(host)
+        if hostSlot and hostSlot.tokens == hostSlot.limit and not hostSlot.waiting:
+            del self.hostSlots[host]
+        return result
+
+    def _fetch(self, url):
+        from twisted.web.http_headers import Headers
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        d = self.agent.request('GET', url, Headers({'User-Agent': [userAgent]}))
+        deadline = reactor.callLater(self.timeout, d.cancel)
+        d.addCallback(self._readResponse)
+
+        def stopDeadline(result):
+            if deadline.active():
+                deadline.cancel()
+            return result
+
+        def timedOut(failure):
+            if deadline.called:
+                raise defer.TimeoutError("no title in %d seconds" % self.timeout)
+            return failure
+        d.addBoth(stopDeadline)
+        d.addErrback(timedOut)
+        return d
+
+    def _readResponse(self, response):
+        from twisted.web import client
+        finalUrl = response.request.absoluteURI
+        contentType = (response.headers.getRawHeaders('content-type') or [''])[0]
+        if 'text/html' not in contentType:
+            response.deliverBody(DiscardBody())
+            if contentType and response.length is not client.UNKNOWN_LENGTH:
+                return ("content-type: " + contentType + ", size " + sizeOf(response.length),
+                        finalUrl)
+            return "aww, what a strange link.", finalUrl
+
+        finished = defer.Deferred(lambda d: titleProtocol.cancel())
+        if self.parsePool:
+            titleProtocol = TitleProtocol(finished, TitleBuffer(self.maxBytes))
+            finished.addCallback(lambda body: self.parsePool.submit(readTitle, [body],
+                charsetOf(contentType), self.maxBytes))
+        else:
+            titleProtocol = TitleProtocol(finished, TitleReader(charsetOf(contentType), self.maxBytes))
+        response.deliverBody(titleProtocol)
+        finished.addCallback(titleText, self.maxBytes)
+        finished.addCallback(lambda text: (text, finalUrl))
+        return finished